@@ -0,0 +1,83 @@
+"""
+Benchmark cone searches on the target table.
+
+Compares extract.extract_cone (index-assisted bounding box) against the
+same query with index scans disabled, and against reading the whole table
+and filtering client-side. Requires a populated database, as configured in
+config.json.
+
+Usage: python benchmarks/cone_search.py [n_cones] [radius_deg]
+"""
+import logging
+import numpy as np
+import os
+import sys
+import time
+sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/.."))
+from scripts import extract
+from scripts.connection import get_connection
+from scripts.extract import extract_cone, extract_from_binary
+
+
+def _time(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def client_side_cone(cursor, ra, dec, radius):
+    """Read the full table, then select the cone with NumPy"""
+    targets = extract_from_binary(cursor, 'target',
+                                  columns=['target_id', 'ux', 'uy', 'uz'])
+    ra, dec = np.radians(ra), np.radians(dec)
+    centre = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                       np.sin(dec)])
+    dot = (targets['ux'] * centre[0] + targets['uy'] * centre[1]
+           + targets['uz'] * centre[2])
+    return targets[dot >= np.cos(np.radians(radius))]
+
+
+def run(n_cones=20, radius=3.):
+    # A cached prepared statement switches to a generic plan, which is not
+    # planned again when the index scans are disabled below, so every cone
+    # search is planned afresh
+    extract.PREPARED_CACHE_SIZE = 0
+    connection = get_connection()
+    cursor = connection.cursor()
+    rng = np.random.RandomState(0)
+    ras = rng.uniform(0., 360., n_cones)
+    decs = np.degrees(np.arcsin(rng.uniform(-1., 0.2, n_cones)))
+
+    timings = {'indexed': [], 'sequential': [], 'client': []}
+    for ra, dec in zip(ras, decs):
+        t, indexed = _time(extract_cone, cursor, 'target', ra, dec, radius,
+                           columns=['target_id'])
+        timings['indexed'].append(t)
+
+        cursor.execute("SET enable_indexscan = off")
+        cursor.execute("SET enable_bitmapscan = off")
+        t, sequential = _time(extract_cone, cursor, 'target', ra, dec, radius,
+                              columns=['target_id'])
+        timings['sequential'].append(t)
+        cursor.execute("RESET enable_indexscan")
+        cursor.execute("RESET enable_bitmapscan")
+
+        t, client = _time(client_side_cone, cursor, ra, dec, radius)
+        timings['client'].append(t)
+
+        assert len(indexed) == len(sequential) == len(client), \
+            "Cone searches returned different results"
+
+    print("%d cones of radius %.2f deg" % (n_cones, radius))
+    for name in ['indexed', 'sequential', 'client']:
+        print("%-12s mean %.4f s  median %.4f s" % (
+            name, np.mean(timings[name]), np.median(timings[name])))
+
+    connection.rollback()
+    connection.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = [float(a) for a in sys.argv[1:]]
+    run(int(args[0]) if args else 20, *args[1:])
@@ -0,0 +1,255 @@
+"""
+Ingest/readout benchmark suite.
+
+For each catalogue size, generates synthetic catalogues, runs the full
+update_database -> readout cycle against a throwaway local PostgreSQL
+cluster, and records the wall time, rows/second and peak RSS of every
+stage in a JSON file. Each stage runs in its own process, so that its peak
+RSS is measured in isolation.
+
+Requires the PostgreSQL server binaries (initdb, pg_ctl) on the PATH, or in
+the directory given by --pg-bin.
+
+Usage: python benchmarks/run_benchmarks.py [--sizes 1e4 1e5 1e6]
+           [--fields 1000] [--output bench_results.json] [--pg-bin DIR]
+           [--parallel] [--defer]
+"""
+import argparse
+import imp
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.queues import Empty
+
+REPO_DIR = os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/..")
+sys.path.append(REPO_DIR)
+sys.path.insert(0, REPO_DIR + os.sep + "scripts")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+VERSION_DIR = REPO_DIR + os.sep + "resources" + os.sep + "0.0.1"
+DATABASE = "taipandb_bench"
+
+
+class ThrowawayPostgres(object):
+    """A temporary PostgreSQL cluster, listening on a Unix socket only"""
+
+    def __init__(self, pg_bin=None):
+        self.pg_bin = pg_bin
+        self.dir = None
+        self.port = None
+
+    def _bin(self, name):
+        return os.path.join(self.pg_bin, name) if self.pg_bin else name
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix="taipandb_bench_")
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        data_dir = os.path.join(self.dir, "data")
+        subprocess.check_call([self._bin("initdb"), "-D", data_dir,
+                               "-U", "postgres", "--auth=trust"],
+                              stdout=subprocess.PIPE)
+        subprocess.check_call([
+            self._bin("pg_ctl"), "-D", data_dir, "-w", "-l",
+            os.path.join(self.dir, "postgres.log"), "-o",
+            "-p %d -k %s -c listen_addresses=''" % (self.port, self.dir),
+            "start"], stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.dir is None:
+            return
+        subprocess.call([self._bin("pg_ctl"), "-D",
+                         os.path.join(self.dir, "data"), "-m", "fast",
+                         "-w", "stop"], stdout=subprocess.PIPE)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir = None
+
+    def config(self):
+        return {"host": self.dir, "port": self.port, "user": "postgres",
+                "database": DATABASE}
+
+    def recreate_database(self):
+        import psycopg2
+        connection = psycopg2.connect(host=self.dir, port=self.port,
+                                      user="postgres", database="postgres")
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("DROP DATABASE IF EXISTS %s" % DATABASE)
+        cursor.execute("CREATE DATABASE %s" % DATABASE)
+        connection.close()
+
+
+def _stage_worker(queue, function, args):
+    try:
+        start = time.time()
+        rows = function(*args)
+        wall = time.time() - start
+    except BaseException as e:
+        # The parent waits for a result, so a failure must be reported too
+        queue.put(("%s: %s" % (type(e).__name__, e), ))
+        raise
+    queue.put((wall, rows,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+
+def _stage_result(queue, process, poll=1.):
+    """Wait for a stage's result, or for its process to die without one"""
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if not process.is_alive():
+                # The process may have put its result just before exiting
+                try:
+                    return queue.get(timeout=poll)
+                except Empty:
+                    return None
+
+
+def run_stage(name, size, function, *args):
+    """Run a benchmark stage in a fresh process, and return its record"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_stage_worker,
+                                      args=(queue, function, args))
+    process.start()
+    result = _stage_result(queue, process)
+    process.join()
+    if result is not None and len(result) == 1:
+        raise RuntimeError("Benchmark stage %s failed: %s" % (name,
+                                                               result[0]))
+    if result is None or process.exitcode != 0:
+        raise RuntimeError("Benchmark stage %s failed with exit code %s" % (
+            name, process.exitcode))
+    wall, rows, rss, rss_children = result
+    record = {
+        "stage": name,
+        "size": size,
+        "rows": rows,
+        "wall_s": wall,
+        "rows_per_s": rows / wall if wall > 0 else None,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": rss,
+        "peak_rss_children_kb": rss_children,
+    }
+    logging.info("%-24s size %-9d rows %-9d %8.2f s %10.0f rows/s %9d kB" % (
+        name, size, rows, wall, record["rows_per_s"] or 0, rss))
+    return record
+
+
+def _connect():
+    from scripts.connection import get_connection
+    return get_connection()
+
+
+def stage_update(parallel, defer):
+    import update
+    connection = _connect()
+    update.update_database(connection, parallel=parallel, defer=defer)
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) FROM target")
+    rows = cursor.fetchall()[0][0]
+    connection.close()
+    return rows
+
+
+def stage_readout(module_name):
+    module = imp.load_source(module_name, VERSION_DIR + os.sep + "readout"
+                             + os.sep + module_name + ".py")
+    connection = _connect()
+    # The readout itself is measured, not the on-disk result cache
+    rows = len(module.execute(connection.cursor(), use_cache=False))
+    connection.close()
+    return rows
+
+
+def stage_extract(method):
+    from scripts import extract
+    connection = _connect()
+    cursor = connection.cursor()
+    columns = ['target_id', 'ra', 'dec', 'ux', 'uy', 'uz']
+    if method == "iter_extract_from":
+        rows = sum(len(chunk) for chunk in extract.iter_extract_from(
+            cursor, 'target', columns=columns))
+    else:
+        rows = len(getattr(extract, method)(cursor, 'target',
+                                            columns=columns))
+    connection.close()
+    return rows
+
+
+def stage_generate(data_dir, size, fields):
+    return sum(synthetic.make_catalogs(data_dir, size, fields).values())
+
+
+def run(sizes, fields, output, pg_bin=None, parallel=False, defer=False):
+    server = ThrowawayPostgres(pg_bin)
+    server.start()
+    records = []
+    try:
+        config_file = os.path.join(server.dir, "config.json")
+        with open(config_file, "w") as f:
+            json.dump(server.config(), f)
+        data_dir = os.path.join(server.dir, "catalogs")
+        os.environ["TAIPANDB_CONFIG"] = config_file
+        os.environ["TAIPANDB_DATA_DIR"] = data_dir
+        # Keep anything cached out of the user's own cache directory
+        os.environ["TAIPANDB_CACHE_DIR"] = os.path.join(server.dir, "cache")
+
+        for size in sizes:
+            size = int(size)
+            server.recreate_database()
+            records.append(run_stage("generate", size, stage_generate,
+                                     data_dir, size, fields))
+            records.append(run_stage("update_database", size, stage_update,
+                                     parallel, defer))
+            for module_name in ["readCentroids", "readGuides",
+                                "readStandards", "readScience"]:
+                records.append(run_stage(module_name, size, stage_readout,
+                                         module_name))
+            for method in ["extract_from", "extract_from_binary",
+                           "iter_extract_from"]:
+                records.append(run_stage(method, size, stage_extract,
+                                         method))
+    finally:
+        server.stop()
+
+    with open(output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "fields": fields, "parallel": parallel, "defer": defer,
+                   "results": records}, f, indent=2)
+    logging.info("Wrote %d benchmark records to %s" % (len(records), output))
+    return records
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", nargs="+", type=float,
+                        default=[1e4, 1e5, 1e6],
+                        help="Science catalogue sizes to benchmark")
+    parser.add_argument("--fields", type=int, default=1000,
+                        help="Number of field pointings")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="JSON file to write the results to")
+    parser.add_argument("--pg-bin", default=None,
+                        help="Directory holding initdb and pg_ctl")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Run the upgrade ingest in parallel mode")
+    parser.add_argument("--defer", action="store_true",
+                        help="Defer constraint and index builds")
+    args = parser.parse_args()
+    run(args.sizes, args.fields, args.output, pg_bin=args.pg_bin,
+        parallel=args.parallel, defer=args.defer)
@@ -0,0 +1,79 @@
+"""
+Generate synthetic TAIPAN input catalogues for benchmarking.
+
+Writes guides.fits, standards.fits, science.fits and pointing_centers.radec
+with the columns expected by the version ingest loaders. Positions are
+uniform on the southern sky; target ids are unique across all catalogues.
+
+Usage: python benchmarks/synthetic.py <out_dir> [n_rows] [n_fields]
+"""
+import numpy as np
+import os
+import sys
+from astropy.table import Table
+
+
+def _random_positions(rng, n, max_dec=10.):
+    """Uniform random positions on the sky below max_dec (degrees)"""
+    ra = rng.uniform(0., 360., n)
+    dec = np.degrees(np.arcsin(
+        rng.uniform(-1., np.sin(np.radians(max_dec)), n)))
+    return ra, dec
+
+
+def make_catalogs(out_dir, n_rows, n_fields=1000, seed=0):
+    """
+    Write a set of synthetic catalogues to out_dir.
+
+    Parameters
+    ----------
+    out_dir:
+        The directory to write the catalogue files to (created if needed).
+    n_rows:
+        Integer, denoting the number of science targets. The guide and
+        standard catalogues are each a tenth of this size.
+    n_fields:
+        Integer, denoting the number of field pointings. Defaults to 1000.
+    seed:
+        Seed for the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    counts:
+        Dictionary of the number of rows written to each file.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rng = np.random.RandomState(seed)
+    n_rows = int(n_rows)
+    n_aux = max(1, n_rows // 10)
+
+    ra, dec = _random_positions(rng, n_fields)
+    with open(os.path.join(out_dir, 'pointing_centers.radec'), 'w') as f:
+        f.write("ra dec\n")
+        np.savetxt(f, np.column_stack([ra, dec]), fmt="%.6f")
+
+    first_id = 1
+    for name in ['guides', 'standards']:
+        ra, dec = _random_positions(rng, n_aux)
+        Table({'objID': np.arange(first_id, first_id + n_aux, dtype='int64'),
+               'ra_SCOS': ra, 'dec_SCOS': dec}).write(
+            os.path.join(out_dir, name + '.fits'), overwrite=True)
+        first_id += n_aux
+
+    ra, dec = _random_positions(rng, n_rows)
+    Table({'uniqid': np.arange(first_id, first_id + n_rows, dtype='int64'),
+           'ra': ra, 'dec': dec,
+           'priority': rng.randint(1, 10, n_rows).astype('int32'),
+           'is_H0': rng.rand(n_rows) < 0.3,
+           'is_vpec': rng.rand(n_rows) < 0.5,
+           'is_lowz': rng.rand(n_rows) < 0.2}).write(
+        os.path.join(out_dir, 'science.fits'), overwrite=True)
+
+    return {'pointing_centers.radec': n_fields, 'guides.fits': n_aux,
+            'standards.fits': n_aux, 'science.fits': n_rows}
+
+
+if __name__ == "__main__":
+    make_catalogs(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1e4,
+                  int(sys.argv[3]) if len(sys.argv) > 3 else 1000)
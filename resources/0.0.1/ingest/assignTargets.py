@@ -0,0 +1,60 @@
+import logging
+import math
+import numpy as np
+from scipy.spatial import cKDTree
+import sys
+import os
+sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
+from scripts.create import copy_columns
+from scripts.extract import extract_from_binary, iter_extract_from
+
+
+# Radius of a field, in degrees
+FIELD_RADIUS = 3.0
+
+
+def _unit_vectors(array):
+    return np.column_stack([array['ux'], array['uy'], array['uz']])
+
+
+def execute(cursor, field_radius=FIELD_RADIUS, chunk_size=100000):
+    """Create a tile for every field, and link every target to the tiles
+    of all fields it lies within"""
+
+    logging.info("Assigning targets to tiles")
+
+    if cursor is None:
+        logging.info("No database - aborting target assignment")
+        return
+
+    # One tile per field
+    cursor.execute("INSERT INTO tile (field_id) "
+                   "SELECT field_id FROM field ORDER BY field_id")
+    fields = extract_from_binary(cursor, 'field',
+                                 columns=['field_id', 'ux', 'uy', 'uz'])
+    tiles = extract_from_binary(cursor, 'tile',
+                                columns=['tile_id', 'field_id'])
+    if len(fields) == 0:
+        logging.info("No fields - nothing to assign")
+        return
+    tiles = tiles[np.argsort(tiles['field_id'])]
+    field_tiles = tiles['tile_id'][
+        np.searchsorted(tiles['field_id'], fields['field_id'])]
+
+    # Targets within field_radius of a field centre are within the matching
+    # chord distance of it in unit vector space
+    chord = 2. * math.sin(math.radians(field_radius) / 2.)
+    field_tree = cKDTree(_unit_vectors(fields))
+
+    links = 0
+    for targets in iter_extract_from(cursor, 'target',
+                                     columns=['target_id', 'ux', 'uy', 'uz'],
+                                     chunk_size=chunk_size):
+        pairs = field_tree.sparse_distance_matrix(
+            cKDTree(_unit_vectors(targets)), chord, output_type='ndarray')
+        links += copy_columns(cursor, 'target_field',
+                              [targets['target_id'][pairs['j']],
+                               field_tiles[pairs['i']]],
+                              columns=['target_id', 'tile_id'])
+
+    logging.info("Assigned %d target-tile links" % links)
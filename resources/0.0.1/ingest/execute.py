@@ -2,20 +2,58 @@ import imp
 import os
 
 
-def update(cursor, filename):
+# Directory holding the input catalogues for this version; may be
+# overridden with the TAIPANDB_DATA_DIR environment variable
+DATA_DIR = os.environ.get("TAIPANDB_DATA_DIR", "/data/resources/0.0.1")
 
-    loadCentroids = imp.load_source('loadCentroids', filename + os.sep + 'loadCentroids.py')
-    fields_file = "/data/resources/0.0.1" + os.sep + 'pointing_centers.radec'
-    loadCentroids.execute(cursor, fields_file=fields_file)
 
-    loadGuides = imp.load_source('loadGuides', filename + os.sep + 'loadGuides.py')
-    guides_file = "/data/resources/0.0.1" + os.sep + 'guides.fits'
-    loadGuides.execute(cursor, guides_file=guides_file)
+def catalog_jobs(filename):
+    """List the catalogue loads for this version, as (loader file, keyword
+    arguments) pairs. The loads are independent of each other, and so may be
+    run in parallel."""
+    jobs = [
+        (filename + os.sep + 'loadCentroids.py',
+         {'fields_file': DATA_DIR + os.sep + 'pointing_centers.radec'}),
+        (filename + os.sep + 'loadGuides.py',
+         {'guides_file': DATA_DIR + os.sep + 'guides.fits'}),
+    ]
+    # Standards and science are only loaded once their catalogues exist
+    standards_file = DATA_DIR + os.sep + 'standards.fits'
+    if os.path.exists(standards_file):
+        jobs.append((filename + os.sep + 'loadStandards.py',
+                     {'standards_file': standards_file}))
+    science_file = DATA_DIR + os.sep + 'science.fits'
+    if os.path.exists(science_file):
+        jobs.append((filename + os.sep + 'loadScience.py',
+                     {'science_file': science_file}))
+    return jobs
 
-    loadStandards = imp.load_source('loadStandards', filename + os.sep + 'loadStandards.py')
-    #loadStandards.execute(cursor)
 
-    loadScience = imp.load_source('loadScience', filename + os.sep + 'loadScience.py')
-    #loadScience.execute(cursor)
+def update(cursor, filename, resume=False):
+    """Load all catalogues, then run the finalize steps. If resume is True,
+    the catalogue loads commit as they go, and pick up from their last
+    checkpoint if a previous (resumable) update was interrupted."""
 
-    # raise Exception("Remove this when all data is loaded in")
\ No newline at end of file
+    for loader_file, kwargs in catalog_jobs(filename):
+        loader = imp.load_source(
+            os.path.splitext(os.path.basename(loader_file))[0], loader_file)
+        if resume:
+            kwargs = dict(kwargs, resume=True)
+        loader.execute(cursor, **kwargs)
+
+    finalize(cursor, filename)
+
+    # raise Exception("Remove this when all data is loaded in")
+
+
+def finalize(cursor, filename):
+    """Steps which depend on the loaded catalogues, run once all of the
+    catalogue loads have completed"""
+
+    assignTargets = imp.load_source(
+        'assignTargets', filename + os.sep + 'assignTargets.py')
+    assignTargets.execute(cursor)
+
+    loadObservability = imp.load_source(
+        'loadObservability', filename + os.sep + 'loadObservability.py')
+    loadObservability.execute(cursor)
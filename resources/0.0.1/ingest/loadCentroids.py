@@ -5,11 +5,11 @@ import os
 import sys
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
 
-from scripts.create import insert_many_rows
-from taipan.core import polar2cart
+from scripts.create import copy_columns, upsert_columns
+from scripts.ingest import polar2cart_columns
 
 
-def execute(cursor, fields_file=None):
+def execute(cursor, fields_file=None, resume=False):
     """Load field pointings from file to database"""
 
     logging.info("Loading Centroids")
@@ -21,15 +21,20 @@ def execute(cursor, fields_file=None):
     # Get centroids
     with open(fields_file, 'r') as fileobj:
         datatable = pd.read_csv(fileobj, delim_whitespace=True)
-    values = [[index, row['ra'], row['dec']]
-              + list(polar2cart((row['ra'], row['dec'])))
-              for index, row in datatable.iterrows()]
+    ra = datatable['ra'].values
+    dec = datatable['dec'].values
+    values = [datatable.index.values, ra, dec] + list(
+        polar2cart_columns(ra, dec))
 
     columns = ["FIELD_ID", "RA", "DEC", "UX", "UY", "UZ"]
 
     # Insert into database
-    if cursor is not None:
-        insert_many_rows(cursor, "field", values, columns=columns)
+    if cursor is not None and resume:
+        # The file is loaded in one pass, so only needs to be idempotent
+        upsert_columns(cursor, "field", values, ["FIELD_ID"], columns)
+        logging.info('Loaded Centroids')
+    elif cursor is not None:
+        copy_columns(cursor, "field", values, columns=columns)
         logging.info('Loaded Centroids')
     else:
         logging.info('No DB to write to - returning values')
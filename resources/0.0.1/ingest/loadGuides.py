@@ -1,35 +1,51 @@
 import logging
-from astropy.table import Table
 import sys
 import os
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.create import insert_many_rows
+from scripts.create import copy_columns
+from scripts.ingest import target_columns, iter_fits_chunks, \
+    get_checkpoint, checkpoint, DEFAULT_CHUNK_SIZE
 
-from taipan.core import polar2cart
-
-def execute(cursor, guides_file=None):
+def execute(cursor, guides_file=None, chunk_size=DEFAULT_CHUNK_SIZE,
+            resume=False):
     logging.info("Loading Guides")
 
     if not guides_file:
         logging.info("No file passed - aborting loading guides")
         return
 
-    # Get guides
-    guides_table = Table.read(guides_file)
+    # In resume mode, each chunk is committed along with a checkpoint, and
+    # loading restarts after the last checkpoint
+    chunks, row_count = get_checkpoint(cursor, guides_file) if resume \
+        else (0, 0)
+    if row_count:
+        logging.info("Resuming guides from row %d" % row_count)
+
+    # Get guides, one chunk at a time
+    values_chunks = []
+    for guides_table in iter_fits_chunks(
+            guides_file, ['objID', 'ra_SCOS', 'dec_SCOS'],
+            chunk_size=chunk_size, start_row=row_count):
+        columns, values_table = target_columns(
+            guides_table['objID'], guides_table['ra_SCOS'],
+            guides_table['dec_SCOS'], is_guide=True)
 
-    values_table = [[row['objID'], row['ra_SCOS'], row['dec_SCOS'],
-                     False, False, True]
-                    + list(polar2cart((row['ra_SCOS'], row['dec_SCOS'])))
-                    for row in guides_table]
-    columns = ["TARGET_ID", "RA", "DEC", "IS_SCIENCE", "IS_STANDARD",
-               "IS_GUIDE", "UX", "UY", "UZ"]
+        # Insert into database. A checkpointed chunk is committed along
+        # with its rows, so is never loaded twice, and id collisions with
+        # other catalogues fail as they do without resume
+        if cursor is not None:
+            copy_columns(cursor, "target", values_table, columns=columns)
+            if resume:
+                chunks += 1
+                row_count += len(values_table[0])
+                checkpoint(cursor, guides_file, chunks, row_count)
+        else:
+            values_chunks.append(values_table)
 
-    # Insert into database
     if cursor is not None:
-        insert_many_rows(cursor, "target", values_table, columns=columns)
         logging.info("Loaded Guides")
     else:
         logging.info('No database - returning values to console')
-        return values_table
+        return values_chunks
 
     return
@@ -0,0 +1,98 @@
+import logging
+import numpy as np
+from astropy.coordinates import get_body, get_sun
+from astropy.time import Time
+import astropy.units as u
+import sys
+import os
+sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
+from scripts.create import copy_columns
+from scripts.extract import extract_from_binary
+
+
+# Location of the UK Schmidt Telescope, Siding Spring Observatory (degrees)
+OBSERVATORY_LATITUDE = -31.2733
+OBSERVATORY_LONGITUDE = 149.0617
+
+# Default survey period and time grid spacing
+SURVEY_START = '2017-01-01'
+SURVEY_END = '2022-01-01'
+STEP_MINUTES = 60.
+
+# Sun altitude (degrees) below which it is astronomically dark
+DARK_SUN_ALTITUDE = -18.
+
+
+def _altitude(lst, ra, dec, latitude=OBSERVATORY_LATITUDE):
+    """Altitude (radians) of positions (radians), broadcast against local
+    sidereal times (radians)"""
+    latitude = np.radians(latitude)
+    sin_alt = (np.sin(latitude) * np.sin(dec)
+               + np.cos(latitude) * np.cos(dec) * np.cos(lst - ra))
+    return np.arcsin(np.clip(sin_alt, -1., 1.))
+
+
+def _local_sidereal_time(times, longitude=OBSERVATORY_LONGITUDE):
+    """Local mean sidereal time (radians) of astropy Times, computed directly
+    from the Julian date (to ~0.1s, without needing UT1 tables)"""
+    gmst = 280.46061837 + 360.98564736629 * (times.utc.jd - 2451545.0)
+    return np.radians(np.mod(gmst + longitude, 360.))
+
+
+def execute(cursor, start=SURVEY_START, end=SURVEY_END,
+            step_minutes=STEP_MINUTES, chunk_size=1000000):
+    """Compute the airmass of every field, and whether it is dark, over a
+    grid of times, and load the results into the observability table.
+
+    Only the grid points at which a field is above the horizon while the Sun
+    is down are stored. The fields x times grid is processed in blocks of
+    whole time steps, with at most chunk_size elements per block."""
+
+    logging.info("Loading Observability")
+
+    if cursor is None:
+        logging.info("No database - aborting loading observability")
+        return
+
+    fields = extract_from_binary(cursor, 'field',
+                                 columns=['field_id', 'ra', 'dec'])
+    if len(fields) == 0:
+        logging.info("No fields - nothing to compute")
+        return
+    field_ra = np.radians(fields['ra'])[:, np.newaxis]
+    field_dec = np.radians(fields['dec'])[:, np.newaxis]
+
+    start = Time(start, scale='utc')
+    n_times = int((Time(end, scale='utc') - start).to(u.min).value
+                  // step_minutes)
+    times_per_chunk = max(1, chunk_size // len(fields))
+    logging.info("Computing observability of %d fields at %d times" % (
+        len(fields), n_times))
+
+    rows = 0
+    for first in range(0, n_times, times_per_chunk):
+        steps = np.arange(first, min(first + times_per_chunk, n_times))
+        times = start + steps * step_minutes * u.min
+        lst = _local_sidereal_time(times)[np.newaxis, :]
+
+        # Sun and Moon positions only depend on time
+        sun = get_sun(times)
+        moon = get_body('moon', times)
+        sun_alt = _altitude(lst, sun.ra.radian, sun.dec.radian)
+        moon_alt = _altitude(lst, moon.ra.radian, moon.dec.radian)
+        dark = (sun_alt < np.radians(DARK_SUN_ALTITUDE)) & (moon_alt < 0.)
+
+        # fields x times grid
+        field_alt = _altitude(lst, field_ra, field_dec)
+        keep = (field_alt > 0.) & (sun_alt < 0.)
+        field_index, time_index = np.nonzero(keep)
+        airmass = 1. / np.sin(field_alt[field_index, time_index])
+
+        rows += copy_columns(cursor, 'observability', [
+            fields['field_id'][field_index],
+            np.asarray(times.iso)[time_index],
+            airmass,
+            dark[0, time_index],
+        ], columns=['field_id', 'date', 'airmass', 'dark'])
+
+    logging.info("Loaded %d observability rows" % rows)
@@ -1,40 +1,59 @@
 import logging
-from astropy.table import Table
+import numpy as np
 import sys
 import os
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.create import insert_many_rows
+from scripts.create import copy_columns
+from scripts.ingest import target_columns, iter_fits_chunks, \
+    get_checkpoint, checkpoint, DEFAULT_CHUNK_SIZE
 
-from taipan.core import polar2cart
 
-
-def execute(cursor, science_file=None):
+def execute(cursor, science_file=None, chunk_size=DEFAULT_CHUNK_SIZE,
+            resume=False):
     logging.info("Loading Science")
 
     if not science_file:
         logging.info("No file passed - aborting loading science")
         return
 
-    # Get science
-    science_table = Table.read(science_file)
+    # In resume mode, each chunk is committed along with a checkpoint, and
+    # loading restarts after the last checkpoint
+    chunks, row_count = get_checkpoint(cursor, science_file) if resume \
+        else (0, 0)
+    if row_count:
+        logging.info("Resuming science from row %d" % row_count)
+
+    # Get science, one chunk at a time
+    for science_table in iter_fits_chunks(
+            science_file,
+            ['uniqid', 'ra', 'dec', 'priority', 'is_H0', 'is_vpec', 'is_lowz'],
+            chunk_size=chunk_size, start_row=row_count):
+        # Do some stuff to convert science_table into values_table
+        # (This is dependent on the structure of science_file)
+        columns1, values_table1 = target_columns(
+            science_table['uniqid'], science_table['ra'], science_table['dec'],
+            is_science=True)
+        values_table2 = [science_table['uniqid'],
+                         science_table['priority'],
+                         np.asarray(science_table['is_H0'], dtype=bool),
+                         np.asarray(science_table['is_vpec'], dtype=bool),
+                         np.asarray(science_table['is_lowz'], dtype=bool)]
+        columns2 = ["TARGET_ID", "PRIORITY", "IS_H0_TARGET", "IS_VPEC_TARGET",
+                    "IS_LOWZ_TARGET"]
 
-    # Do some stuff to convert science_table into values_table
-    # (This is dependent on the structure of science_file)
-    values_table1 = [[row['uniqid'], row['ra'], row['dec'],
-                      True, False, False] 
-                      + list(polar2cart((row['ra'], row['dec'])))
-                     for row in science_table]
-    columns1 = ["TARGET_ID", "RA", "DEC", "IS_SCIENCE", "IS_STANDARD",
-                "IS_GUIDE", "UX", "UY", "UZ"]
-    values_table2 = [[row['uniqid'], row['priority'],
-                      row['is_H0'], row['is_vpec'], row['is_lowz']]
-                     for row in science_table]
-    columns2 = ["TARGET_ID", "PRIORITY", "IS_H0", "IS_VPEC", "IS_LOWZ"]
+        # Insert into database. A checkpointed chunk is committed along
+        # with its rows, so is never loaded twice, and id collisions with
+        # other catalogues fail as they do without resume
+        if cursor is not None:
+            copy_columns(cursor, "target", values_table1, columns=columns1)
+            copy_columns(cursor, "science_target", values_table2,
+                         columns=columns2)
+            if resume:
+                chunks += 1
+                row_count += len(values_table2[0])
+                checkpoint(cursor, science_file, chunks, row_count)
 
-    # Insert into database
     if cursor is not None:
-        insert_many_rows(cursor, "target", values_table1, columns=columns1)
-        insert_many_rows(cursor, "science_target", values_table2, columns=columns2)
         logging.info("Loaded Science")
     else:
         logging.info("No database - however, dry-run of loading successful")
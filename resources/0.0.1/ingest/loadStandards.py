@@ -1,34 +1,52 @@
 import logging
-from astropy.table import Table
 import os
 import sys
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.create import insert_many_rows
+from scripts.create import copy_columns
+from scripts.ingest import target_columns, iter_fits_chunks, \
+    get_checkpoint, checkpoint, DEFAULT_CHUNK_SIZE
 
-from taipan.core import polar2cart
 
-
-def execute(cursor, standards_file=None):
+def execute(cursor, standards_file=None, chunk_size=DEFAULT_CHUNK_SIZE,
+            resume=False):
     logging.info("Loading Standards")
 
     if not standards_file:
         logging.info("No file passed - aborting loading standards")
         return
 
-    # Get guides
-    standards_table = Table.read(standards_file)
-
-    values_table = [[row['objID'], row['ra_SCOS'], row['dec_SCOS'], False, True, False] +
-                    list(polar2cart((row['ra_SCOS'], row['dec_SCOS']))) for row in standards_table]
-    columns = ["TARGET_ID", "RA", "DEC", "IS_SCIENCE", "IS_STANDARD",
-               "IS_GUIDE", "UX", "UY", "UZ"]
+    # In resume mode, each chunk is committed along with a checkpoint, and
+    # loading restarts after the last checkpoint
+    chunks, row_count = get_checkpoint(cursor, standards_file) if resume \
+        else (0, 0)
+    if row_count:
+        logging.info("Resuming standards from row %d" % row_count)
+
+    # Get standards, one chunk at a time
+    values_chunks = []
+    for standards_table in iter_fits_chunks(
+            standards_file, ['objID', 'ra_SCOS', 'dec_SCOS'],
+            chunk_size=chunk_size, start_row=row_count):
+        columns, values_table = target_columns(
+            standards_table['objID'], standards_table['ra_SCOS'],
+            standards_table['dec_SCOS'], is_standard=True)
+
+        # Insert into database. A checkpointed chunk is committed along
+        # with its rows, so is never loaded twice, and id collisions with
+        # other catalogues fail as they do without resume
+        if cursor is not None:
+            copy_columns(cursor, "target", values_table, columns=columns)
+            if resume:
+                chunks += 1
+                row_count += len(values_table[0])
+                checkpoint(cursor, standards_file, chunks, row_count)
+        else:
+            values_chunks.append(values_table)
 
-    # Insert into database
     if cursor is not None:
-        insert_many_rows(cursor, "target", values_table, columns=columns)
         logging.info("Loaded Standards")
     else:
         logging.info('No database - returning values to console')
-        return values_table
+        return values_chunks
 
     return
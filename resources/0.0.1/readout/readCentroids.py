@@ -2,15 +2,18 @@ import logging
 import sys
 import os
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.extract import extract_from
+from scripts.cache import cached_extract
+from scripts.extract import extract_from_binary
 from taipan.core import TaipanTile
 
 
-def execute(cursor):
+def execute(cursor, use_cache=True):
     logging.info('Reading tile centroids from database')
 
-    centroids_db = extract_from(cursor, 'field', conditions=[('is_guide', True)],
-                                columns=['field_id', 'ra', 'dec', 'ux', 'uy', 'uz'])
+    centroids_db = cached_extract(
+        cursor, extract_from_binary, 'field',
+        columns=['field_id', 'ra', 'dec', 'ux', 'uy', 'uz'],
+        use_cache=use_cache)
 
     return_objects = [TaipanTile(c['ra'], c['dec']) for c in centroids_db]
 
@@ -2,21 +2,45 @@ import logging
 import sys
 import os
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.extract import extract_from
+from scripts.cache import cached_extract
+from scripts.collection import TargetCollection
+from scripts.extract import extract_from_binary, iter_extract_from
 from taipan.core import TaipanTarget
 
-def execute(cursor):
+def execute(cursor, use_cache=True):
     logging.info('Reading guides from database')
 
-    guides_db = extract_from(cursor, 'target', conditions=[
+    guides_db = cached_extract(cursor, extract_from_binary, 'target', conditions=[
         ('is_guide', True),
         ],
-        columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz'])
+        columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz'],
+        use_cache=use_cache)
 
-    return_objects = [TaipanTarget(
-        g['target_id'], g['ra'], g['dec'], guide=True,
-        ucposn=(g['ux'], g['uy'], g['uz']),
-        ) for g in guides_db]
+    return_objects = TargetCollection(guides_db, _to_target)
 
     logging.info('Extracted %d guides from database' % guides_db.shape[0])
     return return_objects
+
+
+def iter_execute(cursor, chunk_size=10000):
+    """Read guides from the database, yielding TargetCollections of up to
+    chunk_size targets at a time"""
+    logging.info('Streaming guides from database')
+
+    count = 0
+    for guides_db in iter_extract_from(cursor, 'target', conditions=[
+            ('is_guide', True),
+            ],
+            columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz'],
+            chunk_size=chunk_size):
+        count += guides_db.shape[0]
+        yield TargetCollection(guides_db, _to_target)
+
+    logging.info('Streamed %d guides from database' % count)
+
+
+def _to_target(g):
+    return TaipanTarget(
+        g['target_id'], g['ra'], g['dec'], guide=True,
+        ucposn=(g['ux'], g['uy'], g['uz']),
+        )
@@ -2,20 +2,42 @@ import logging
 import sys
 import os
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.extract import extract_from_joined
+from scripts.cache import cached_extract
+from scripts.collection import TargetCollection
+from scripts.extract import extract_from_binary, iter_extract_from
 from taipan.core import TaipanTarget
 
-def execute(cursor):
+def execute(cursor, use_cache=True):
     logging.info('Reading guides from database')
 
-    targets_db = extract_from_joined(cursor, ['target', 'science_target'],
-        conditions=[('is_science', True)],
-        columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz', 'priority'])
+    # science_view holds the science rows of the target/science_target join
+    targets_db = cached_extract(cursor, extract_from_binary, 'science_view',
+        columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz', 'priority'],
+        use_cache=use_cache)
 
-    return_objects = [TaipanTarget(
-        g['target_id'], g['ra'], g['dec'], priority=g['priority'],
-        ucposn=(g['ux'], g['uy'], g['uz']),
-        ) for g in targets_db]
+    return_objects = TargetCollection(targets_db, _to_target)
 
-    logging.info('Extracted %d targets from database' % return_objects.shape[0])
+    logging.info('Extracted %d targets from database' % len(return_objects))
     return return_objects
+
+
+def iter_execute(cursor, chunk_size=10000):
+    """Read science targets from the database, yielding TargetCollections of
+    up to chunk_size targets at a time"""
+    logging.info('Streaming science targets from database')
+
+    count = 0
+    for targets_db in iter_extract_from(cursor, 'science_view',
+            columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz', 'priority'],
+            chunk_size=chunk_size):
+        count += targets_db.shape[0]
+        yield TargetCollection(targets_db, _to_target)
+
+    logging.info('Streamed %d targets from database' % count)
+
+
+def _to_target(g):
+    return TaipanTarget(
+        g['target_id'], g['ra'], g['dec'], priority=g['priority'],
+        ucposn=(g['ux'], g['uy'], g['uz']),
+        )
@@ -2,17 +2,25 @@ import logging
 import sys
 import os
 sys.path.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + "/../../.."))
-from scripts.extract import extract_from
+from scripts.cache import cached_extract
+from scripts.collection import TargetCollection
+from scripts.extract import extract_from_binary
 from taipan.core import TaipanTarget
 
-def execute(cursor):
+def execute(cursor, use_cache=True):
     logging.info('Reading standards from database')
 
-    standards_db = extract_from(cursor, 'target', conditions=[('is_standard', True)],
-                                columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz'])
+    standards_db = cached_extract(
+        cursor, extract_from_binary, 'target', conditions=[('is_standard', True)],
+        columns=['target_id', 'ra', 'dec', 'ux', 'uy', 'uz'],
+        use_cache=use_cache)
 
-    return_objects = [TaipanTarget(s['target_id'], s['ra'], s['dec'], standard=True,
-                                   ucposn=(s['ux'], s['uy'], s['uz'])) for s in standards_db]
+    return_objects = TargetCollection(standards_db, _to_target)
 
     logging.info('Extracted %d standards from database' % standards_db.shape[0])
     return return_objects
+
+
+def _to_target(s):
+    return TaipanTarget(s['target_id'], s['ra'], s['dec'], standard=True,
+                        ucposn=(s['ux'], s['uy'], s['uz']))
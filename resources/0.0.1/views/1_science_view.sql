@@ -0,0 +1,9 @@
+# science_view materialized view
+# Science targets with their positions, unit vectors and priorities, as read
+# by readScience, so the target/science_target join is not redone per readout.
+# The view is only refreshed by upgrades, so it holds none of the columns
+# changed by the nightly bookkeeping (repeats, done)
+# @index science_view_target_idx unique btree (target_id)
+SELECT target_id, ra, dec, ux, uy, uz, priority
+FROM target NATURAL JOIN science_target
+WHERE is_science
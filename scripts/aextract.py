@@ -0,0 +1,278 @@
+import asyncio
+import logging
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+from connection import get_config, _connect_args, POOL_CONFIG_KEY, \
+    DEFAULT_POOL_MAX
+from extract import _select_string, _select_structure, _numpy_dtype
+from instrument import measure
+
+
+async def _wait(connection):
+    """
+    Wait, without blocking the event loop, until the pending operation on an
+    asynchronous connection has completed.
+    """
+    loop = asyncio.get_running_loop()
+    fd = connection.fileno()
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError("Unexpected poll state %s" %
+                                            state)
+
+
+async def get_async_connection():
+    """
+    Open a new asynchronous database connection.
+
+    Asynchronous connections are always in autocommit mode.
+
+    Returns
+    -------
+    connection:
+        A psycopg2 connection, opened with async_=True.
+    """
+    connection = psycopg2.connect(async_=True,
+                                  **_connect_args(get_config()))
+    await _wait(connection)
+    logging.info("Got asynchronous database connection")
+    return connection
+
+
+def _configured_pool_size():
+    return get_config().get(POOL_CONFIG_KEY, {}).get("max", DEFAULT_POOL_MAX)
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of asynchronous connections, shared by the coroutines of one event
+    loop. Connections are opened as required, up to size at once; further
+    coroutines wait for a connection to be released.
+
+    Parameters
+    ----------
+    size:
+        The maximum number of connections. Defaults to None, which uses the
+        "max" pool size from the configuration file.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = _configured_pool_size()
+        self.size = size
+        self._idle = []
+        self._all = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def acquire(self):
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                connection = self._idle.pop()
+                if not connection.closed:
+                    return connection
+                self._all.remove(connection)
+            connection = await get_async_connection()
+            self._all.append(connection)
+            return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        if not connection.closed:
+            self._idle.append(connection)
+        else:
+            self._all.remove(connection)
+        self._slots.release()
+
+    def close(self):
+        """Close all connections in the pool"""
+        for connection in self._all:
+            if not connection.closed:
+                connection.close()
+        self._idle = []
+        self._all = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _fetch_rows(cursor, convert):
+    """
+    Fetch the result rows from a cursor, and convert them with
+    convert(description, rows) if given.
+    """
+    rows = cursor.fetchall()
+    if convert is None:
+        return rows
+    return convert(cursor.description, rows)
+
+
+async def _fetch(pool, string, params=None, convert=None):
+    """
+    Execute a statement on a pooled connection, and return the result rows,
+    or the result of convert(description, rows) if convert is given.
+
+    Fetching the rows (which converts each value to a Python object) and
+    converting them are CPU-bound, so are run in the event loop's default
+    executor, leaving the loop free to drive the other queries.
+    """
+    loop = asyncio.get_running_loop()
+    connection = await pool.acquire()
+    try:
+        cursor = connection.cursor()
+        # EXPLAIN needs a synchronous cursor, so no cursor is passed here
+        with measure(None, string) as m:
+            cursor.execute(string, params)
+            await _wait(connection)
+            result = await loop.run_in_executor(None, _fetch_rows, cursor,
+                                                convert)
+            m.rows = len(result)
+        cursor.close()
+    except BaseException:
+        # Don't hand out a connection left in an unknown state (e.g. with
+        # the query still running, if this coroutine was cancelled)
+        connection.close()
+        raise
+    finally:
+        pool.release(connection)
+    return result
+
+
+async def aextract_from(pool, table, conditions=None, columns=None):
+    """
+    Extract rows from a database table (or join), without blocking the event
+    loop.
+
+    Parameters
+    ----------
+    pool:
+        The AsyncConnectionPool to run the query on.
+    table:
+        The name of the table to be read, or a list of table names to be
+        NATURAL JOINed.
+    conditions:
+        The conditions rows must satisfy, as for extract.extract_from.
+        Defaults to None.
+    columns:
+        List of column names to retrieve from the database. Defaults to None,
+        which returns all available columns.
+
+    Returns
+    -------
+    result:
+        A numpy structured array of all table rows which satisfy conditions
+        (if given), as for extract.extract_from.
+    """
+    if isinstance(table, list):
+        table = ' NATURAL JOIN '.join(table)
+    string, params = _select_string(table, columns, conditions)
+    logging.debug("%s with values %s" % (string, params))
+
+    def convert(description, rows):
+        result_columns, dtypes = _select_structure(columns, description)
+        return np.asarray(rows, dtype=_numpy_dtype(result_columns, dtypes,
+                                                   rows))
+
+    return await _fetch(pool, string, params, convert)
+
+
+async def aexecute_select(pool, statement):
+    """
+    Execute an arbitrary SELECT statement, without blocking the event loop.
+
+    Parameters
+    ----------
+    pool:
+        The AsyncConnectionPool to run the query on.
+    statement:
+        The SELECT statement query to execute.
+
+    Returns
+    -------
+    list
+        The results of the query, each row being an element in the list.
+    """
+    assert statement.upper().find("SELECT") == 0, "You must submit a SELECT statement, that begins with SELECT"
+    logging.info("Executing statement: %s" % statement)
+    rows = await _fetch(pool, statement)
+    logging.info("Found %d rows" % len(rows))
+    return rows
+
+
+async def aextract_many(queries, pool=None):
+    """
+    Run several extracts concurrently.
+
+    Parameters
+    ----------
+    queries:
+        Dictionary mapping a name to the (table, conditions, columns)
+        arguments of aextract_from, or to a SELECT statement string for
+        aexecute_select.
+    pool:
+        The AsyncConnectionPool to use. Defaults to None, which uses (and
+        then closes) a new pool with one connection per query, up to the
+        configured maximum.
+
+    Returns
+    -------
+    results:
+        Dictionary mapping each name in queries to its result.
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = AsyncConnectionPool(
+            min(_configured_pool_size(), max(len(queries), 1)))
+    try:
+        names = list(queries)
+        tasks = []
+        for name in names:
+            query = queries[name]
+            if isinstance(query, str):
+                tasks.append(aexecute_select(pool, query))
+            else:
+                tasks.append(aextract_from(pool, *query))
+        results = await asyncio.gather(*tasks)
+    finally:
+        if own_pool:
+            pool.close()
+    return dict(zip(names, results))
+
+
+def extract_many(queries):
+    """
+    Run several extracts concurrently, from synchronous code.
+
+    This runs aextract_many in a new event loop; see that function for the
+    parameters. The total time taken is roughly that of the slowest query.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(aextract_many(queries))
+    finally:
+        loop.close()
@@ -0,0 +1,244 @@
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+
+from create import TABLE_CHANGE_TABLE, TABLE_CHANGE_FUNCTION
+
+
+# Directory holding the cached readout files; override with the
+# TAIPANDB_CACHE_DIR environment variable
+DEFAULT_CACHE_DIR = os.environ.get(
+    "TAIPANDB_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".taipandb", "cache"))
+# Maximum total size (bytes) of the cache before the least recently used
+# files are evicted; override with TAIPANDB_CACHE_SIZE
+DEFAULT_CACHE_SIZE = int(os.environ.get("TAIPANDB_CACHE_SIZE", 2 * 1024 ** 3))
+
+CACHE_SUFFIX = ".npy"
+
+
+def table_marker(cursor, tables):
+    """
+    Compute a marker which changes whenever the database version or the
+    content of any of the given tables changes.
+
+    The marker combines the current database version with each table's oid,
+    and its latest stamp and total count of changes in the
+    TABLE_CHANGE_TABLE, to which a stamp (a new sequence value, counting one
+    change) is appended by every statement that changes the table's rows
+    (or, for a materialized view, by create.refresh_views). The stamps are
+    ordinary rows, so they change in the same transaction as the table
+    content. As sequence values are never reused, a stamp from a rolled back
+    transaction is never seen again, and as the count only grows, a
+    transaction which commits after one with a later stamp is still seen.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database.
+    tables:
+        List of table names.
+
+    Returns
+    -------
+    marker:
+        A tuple describing the current state of the tables, or None if any
+        of them is a table without the change stamp triggers (e.g. one
+        created before change stamps were introduced), whose changes can't
+        be detected.
+    """
+    cursor.execute("SELECT version, version_date FROM version v "
+                   "ORDER BY v.version_date DESC LIMIT 1")
+    version = tuple(str(v) for v in cursor.fetchall()[0])
+
+    cursor.execute("SELECT c.relname, c.oid, "
+                   "coalesce(t.stamp, 0), coalesce(t.changes, 0), "
+                   "c.relkind = 'm' OR EXISTS (SELECT 1 FROM pg_trigger g "
+                   "WHERE g.tgrelid = c.oid AND g.tgname = "
+                   "c.relname || '_' || %%s || '_insert') "
+                   "FROM pg_class c "
+                   "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "LEFT JOIN (SELECT table_name, max(stamp) AS stamp, "
+                   "sum(changes)::bigint AS changes FROM %s "
+                   "WHERE table_name = ANY(%%s) GROUP BY table_name) t "
+                   "ON t.table_name = c.relname "
+                   "WHERE n.nspname = current_schema() "
+                   "AND c.relname = ANY(%%s) ORDER BY c.relname" % (
+                       TABLE_CHANGE_TABLE, ),
+                   (TABLE_CHANGE_FUNCTION, list(tables), list(tables)))
+    rows = cursor.fetchall()
+    if len(rows) != len(set(tables)):
+        raise ValueError("Could not find all of %s" % (tables, ))
+    if not all(row[-1] for row in rows):
+        return None
+    return version + tuple(tuple(row[:-1]) for row in rows)
+
+
+def _cache_files(cache_dir):
+    """
+    List the cache files, least recently used first, as (path, size) pairs.
+    """
+    files = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(CACHE_SUFFIX):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed by a concurrent process
+            continue
+        files.append((stat.st_mtime, path, stat.st_size))
+    files.sort()
+    return [(path, size) for _, path, size in files]
+
+
+def evict(cache_dir=None, max_bytes=None, keep=None):
+    """
+    Remove least recently used cache files until the cache fits in max_bytes.
+
+    Parameters
+    ----------
+    cache_dir:
+        The cache directory. Defaults to None, which uses DEFAULT_CACHE_DIR.
+    max_bytes:
+        The maximum total size of the cache. Defaults to None, which uses
+        DEFAULT_CACHE_SIZE.
+    keep:
+        Path of a file which should never be evicted. Defaults to None.
+
+    Returns
+    -------
+    removed:
+        The number of files removed.
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = DEFAULT_CACHE_SIZE
+    if not os.path.isdir(cache_dir):
+        return 0
+    files = _cache_files(cache_dir)
+    total = sum(size for _, size in files)
+    removed = 0
+    for path, size in files:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        logging.debug("Evicted %s from readout cache" % path)
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear(cache_dir=None):
+    """
+    Remove all files from the readout cache.
+    """
+    evict(cache_dir=cache_dir, max_bytes=-1)
+
+
+def cached_extract(cursor, extract, table, conditions=None, columns=None,
+                   use_cache=True, cache_dir=None, max_bytes=None):
+    """
+    Extract from the database through the on-disk readout cache.
+
+    Results are stored as .npy files, keyed by the query and by the
+    table_marker of the tables read, so that the cache is invalidated by a
+    database version upgrade or any change to the tables. Cache hits are
+    returned memory-mapped (read-only). The cache is bounded to max_bytes by
+    least recently used eviction.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database. If None (or
+        an offline snapshot.Snapshot), the cache is bypassed and extract is
+        called directly.
+    extract:
+        The extract function to call on a cache miss, e.g.
+        extract.extract_from_binary. It is called as
+        extract(cursor, table, conditions=conditions, columns=columns).
+    table:
+        The table name, or list of table names to be joined.
+    conditions:
+        As for the extract function.
+    columns:
+        As for the extract function.
+    use_cache:
+        Set to False to bypass the cache. Defaults to True.
+    cache_dir:
+        The cache directory. Defaults to None, which uses DEFAULT_CACHE_DIR.
+    max_bytes:
+        The maximum total size of the cache. Defaults to None, which uses
+        DEFAULT_CACHE_SIZE.
+
+    Returns
+    -------
+    result:
+        The numpy structured array returned by extract (or a read-only
+        memory map of it).
+    """
+    if cursor is None or not use_cache or \
+            getattr(cursor, "is_snapshot", False):
+        return extract(cursor, table, conditions=conditions, columns=columns)
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+
+    tables = table if isinstance(table, list) else [table]
+    marker = table_marker(cursor, tables)
+    if marker is None:
+        logging.info("Changes to %s cannot be detected, bypassing readout "
+                     "cache" % (tables, ))
+        return extract(cursor, table, conditions=conditions, columns=columns)
+
+    key = hashlib.sha1(repr((extract.__name__, tables, conditions, columns,
+                             marker)).encode("utf-8")).hexdigest()
+    path = os.path.join(cache_dir, "%s_%s%s" % (
+        "-".join(tables), key, CACHE_SUFFIX))
+
+    if os.path.exists(path):
+        try:
+            result = np.load(path, mmap_mode="r")
+        except (IOError, ValueError) as e:
+            logging.warning("Discarding unreadable cache file %s: %s" % (
+                path, e))
+        else:
+            # The modification time records the last use, for LRU eviction
+            os.utime(path, None)
+            logging.info("Read %d rows of %s from readout cache" % (
+                len(result), tables))
+            return result
+
+    start = time.time()
+    result = extract(cursor, table, conditions=conditions, columns=columns)
+    logging.info("Readout cache miss for %s, extracted in %.3f s" % (
+        tables, time.time() - start))
+    if table_marker(cursor, tables) != marker:
+        # Changed by a transaction which committed during the extract, so the
+        # result may not match the marker
+        return result
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created by a concurrent process
+            if not os.path.isdir(cache_dir):
+                raise
+    # Write to a temporary file first, so that concurrent readers never see
+    # a partial file
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, result, allow_pickle=False)
+    os.rename(tmp_path, path)
+    evict(cache_dir=cache_dir, max_bytes=max_bytes, keep=path)
+    return result
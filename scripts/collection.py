@@ -0,0 +1,293 @@
+import numpy as np
+
+
+class _TargetStore(object):
+    """
+    The rows and target objects shared by a TargetCollection and all the
+    collections derived from it.
+
+    Each element of a collection is a key into the store: keys >= 0 are row
+    numbers of the array, and keys < 0 denote objects which were added to a
+    collection without a row (e.g. targets built elsewhere and appended).
+    """
+
+    def __init__(self, array, factory):
+        self.array = array
+        self.factory = factory
+        self.objects = {}
+        self.keys = {}
+        self.added = 0
+
+    def get(self, key):
+        if key not in self.objects:
+            obj = self.factory(self.array[key])
+            self.objects[key] = obj
+            self.keys[id(obj)] = key
+        return self.objects[key]
+
+    def find(self, obj):
+        """Get the key of obj, or None if it is not held by the store"""
+        key = self.keys.get(id(obj))
+        if key is not None and self.objects[key] is obj:
+            return key
+        return None
+
+    def add(self, obj):
+        """Get the key of obj, adding it as a row-less object if required"""
+        key = self.find(obj)
+        if key is None:
+            self.added += 1
+            key = -self.added
+            self.objects[key] = obj
+            self.keys[id(obj)] = key
+        return key
+
+
+class TargetCollection(object):
+    """
+    An array-backed list of targets.
+
+    The targets are held as a numpy structured array (as returned by the
+    extract functions), and target objects are only built, by calling
+    factory on the corresponding row, when an element is accessed. Each
+    object is built at most once, and is shared by every collection sliced
+    or filtered from the same one, so that e.g. collection[0:1][0] is
+    collection[0].
+
+    Indexing with an integer returns a target object; indexing with a slice,
+    boolean mask or integer array returns a new TargetCollection over the
+    selected rows, without building any objects. Columns are available as
+    arrays, e.g. collection['priority'].
+
+    The collection supports the list interface (append, extend, insert,
+    remove, pop, index, count, sort, reverse, + and item assignment and
+    deletion). Targets which were not read from the array (and which are not
+    elements of a collection derived from the same one) may be added, but
+    have no row, so the column access methods then raise ValueError.
+
+    Parameters
+    ----------
+    array:
+        The numpy structured array of target rows.
+    factory:
+        Function taking one row of array and returning the target object.
+    """
+
+    def __init__(self, array, factory, _store=None, _rows=None):
+        self._store = _store if _store is not None else \
+            _TargetStore(array, factory)
+        # The keys of the elements (see _TargetStore), or None for all the
+        # rows of the array, in order
+        self._rows = _rows
+        self._array = array if _rows is None else None
+
+    def _keys(self):
+        if self._rows is None:
+            return np.arange(len(self._store.array))
+        return self._rows
+
+    def _derive(self, rows):
+        return TargetCollection(None, None, _store=self._store,
+                                _rows=np.asarray(rows, dtype=np.intp))
+
+    def _set_keys(self, rows):
+        self._rows = np.asarray(rows, dtype=np.intp)
+        self._array = None
+
+    def _position(self, item):
+        n = len(self)
+        if item < 0:
+            item += n
+        if not 0 <= item < n:
+            raise IndexError("TargetCollection index out of range")
+        return item
+
+    @property
+    def factory(self):
+        return self._store.factory
+
+    @property
+    def array(self):
+        """The numpy structured array of the targets' rows"""
+        if self._array is None:
+            keys = self._keys()
+            if (keys < 0).any():
+                raise ValueError("TargetCollection holds targets which were "
+                                 "added as objects, and have no rows")
+            self._array = self._store.array[keys]
+        return self._array
+
+    def __len__(self):
+        if self._rows is None:
+            return len(self._store.array)
+        return len(self._rows)
+
+    def __iter__(self):
+        for key in self._keys():
+            yield self._store.get(key)
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.array[item]
+        if isinstance(item, (int, np.integer)):
+            if self._rows is None:
+                return self._store.get(self._position(item))
+            return self._store.get(self._rows[self._position(item)])
+        return self._derive(self._keys()[item])
+
+    def __setitem__(self, item, obj):
+        if not isinstance(item, (int, np.integer)):
+            raise TypeError("TargetCollection only supports assigning to "
+                            "single elements")
+        rows = self._keys().copy()
+        rows[self._position(item)] = self._store.add(obj)
+        self._set_keys(rows)
+
+    def __delitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            item = self._position(item)
+        self._set_keys(np.delete(self._keys(), item))
+
+    def __contains__(self, obj):
+        try:
+            self.index(obj)
+        except ValueError:
+            return False
+        return True
+
+    def __add__(self, other):
+        result = self._derive(self._keys())
+        result.extend(other)
+        return result
+
+    def __radd__(self, other):
+        return list(other) + self.to_list()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __repr__(self):
+        return "TargetCollection(%d targets, columns %s)" % (
+            len(self), list(self._store.array.dtype.names))
+
+    def append(self, obj):
+        """Add a target to the end of the collection"""
+        self._set_keys(np.append(self._keys(), self._store.add(obj)))
+
+    def extend(self, targets):
+        """Add targets (any iterable of them) to the end of the collection"""
+        if isinstance(targets, TargetCollection) and \
+                targets._store is self._store:
+            rows = targets._keys()
+        else:
+            rows = [self._store.add(obj) for obj in targets]
+        self._set_keys(np.concatenate((self._keys(),
+                                       np.asarray(rows, dtype=np.intp))))
+
+    def insert(self, item, obj):
+        """Insert a target before position item"""
+        n = len(self)
+        if item < 0:
+            item = max(item + n, 0)
+        self._set_keys(np.insert(self._keys(), min(item, n),
+                                 self._store.add(obj)))
+
+    def pop(self, item=-1):
+        """Remove and return the target at position item (default last)"""
+        obj = self[item]
+        del self[item]
+        return obj
+
+    def remove(self, obj):
+        """Remove the first occurrence of a target"""
+        del self[self.index(obj)]
+
+    def index(self, obj, start=0, stop=None):
+        """
+        Get the position of the first occurrence of a target. Targets are
+        matched by identity first, and then by equality (which builds the
+        target objects).
+        """
+        keys = self._keys()[start:stop]
+        offset = range(len(self))[start:stop]
+        key = self._store.find(obj)
+        if key is not None:
+            found = np.flatnonzero(keys == key)
+            if len(found):
+                return offset[found[0]]
+        for i, k in enumerate(keys):
+            if self._store.get(k) == obj:
+                return offset[i]
+        raise ValueError("Target is not in the TargetCollection")
+
+    def count(self, obj):
+        """Count the occurrences of a target"""
+        return sum(1 for target in self if target is obj or target == obj)
+
+    def sort(self, key=None, reverse=False):
+        """
+        Sort the collection in place, as list.sort. This builds the target
+        objects; to sort by a column, index with an argsort of it instead,
+        e.g. collection[np.argsort(collection['priority'])].
+        """
+        targets = self.to_list()
+        order = sorted(range(len(targets)),
+                       key=lambda i: key(targets[i]) if key is not None
+                       else targets[i], reverse=reverse)
+        self._set_keys(self._keys()[np.asarray(order, dtype=np.intp)])
+
+    def reverse(self):
+        """Reverse the collection in place"""
+        self._set_keys(self._keys()[::-1])
+
+    @property
+    def columns(self):
+        """The names of the available columns"""
+        return list(self._store.array.dtype.names)
+
+    @property
+    def ucposn(self):
+        """The (N, 3) array of target unit vectors"""
+        return np.column_stack((self.array['ux'], self.array['uy'],
+                                self.array['uz']))
+
+    def filter(self, mask):
+        """
+        Select the targets for which mask is True.
+
+        Parameters
+        ----------
+        mask:
+            Boolean array with one element per target, e.g.
+            collection['priority'] > 5.
+
+        Returns
+        -------
+        collection:
+            A new TargetCollection over the selected rows.
+        """
+        return self[np.asarray(mask, dtype=bool)]
+
+    def within(self, ucposn, radius):
+        """
+        Select the targets within an angular distance of a position.
+
+        Parameters
+        ----------
+        ucposn:
+            The (x, y, z) unit vector of the position.
+        radius:
+            The angular distance, in degrees.
+
+        Returns
+        -------
+        collection:
+            A new TargetCollection over the selected rows.
+        """
+        return self.filter(np.dot(self.ucposn, ucposn) >=
+                           np.cos(np.radians(radius)))
+
+    def to_list(self):
+        """Build (or reuse) the target objects for all rows, as a list"""
+        return list(self)
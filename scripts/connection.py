@@ -1,21 +1,189 @@
+import contextlib
 import json
 import os
 import psycopg2
+import psycopg2.pool
 import logging
+import threading
 
 
-def get_config(conf_filename="../config.json"):
-    logging.info("Getting config from %s" % conf_filename)
+# Key of the config.json entry holding the connection pool settings, which
+# are not passed through to psycopg2.connect
+POOL_CONFIG_KEY = "pool"
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+
+# Parsed config files, keyed by absolute path
+_config_cache = {}
+
+# The shared connection pool, created on first use by get_pool
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+def get_config(conf_filename=None):
+    """
+    Read the database configuration.
+
+    The parsed configuration is cached, so the file is only read once per
+    process.
+
+    Parameters
+    ----------
+    conf_filename:
+        The path of the configuration file, relative to this directory (or
+        absolute). Defaults to None, which uses the TAIPANDB_CONFIG
+        environment variable if set, and ../config.json otherwise.
+
+    Returns
+    -------
+    config:
+        A dictionary of the configuration values.
+    """
+    if conf_filename is None:
+        conf_filename = os.environ.get("TAIPANDB_CONFIG", "../config.json")
     dir = os.path.dirname(__file__)
     if not dir:
         dir = "."
-    config_file = dir + os.sep + conf_filename
-    with open(config_file) as data_file:
-        config = json.load(data_file)
+    config_file = os.path.abspath(os.path.join(dir, conf_filename))
+    if config_file not in _config_cache:
+        logging.info("Getting config from %s" % config_file)
+        with open(config_file) as data_file:
+            _config_cache[config_file] = json.load(data_file)
+    return dict(_config_cache[config_file])
+
+
+def _connect_args(config):
+    """
+    Strip the non-psycopg2 entries from a configuration dictionary.
+    """
+    config = dict(config)
+    config.pop(POOL_CONFIG_KEY, None)
     return config
 
 
 def get_connection():
-    connection = psycopg2.connect(**get_config())
+    connection = psycopg2.connect(**_connect_args(get_config()))
     logging.info("Got database connection")
     return connection
+
+
+def get_pool():
+    """
+    Get the shared, thread-safe connection pool, creating it if required.
+
+    The minimum and maximum pool sizes are read from the "pool" entry of the
+    configuration file ({"min": ..., "max": ...}), and default to
+    DEFAULT_POOL_MIN and DEFAULT_POOL_MAX.
+
+    Returns
+    -------
+    pool:
+        The psycopg2.pool.ThreadedConnectionPool instance.
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            config = get_config()
+            pool_config = config.get(POOL_CONFIG_KEY, {})
+            minconn = pool_config.get("min", DEFAULT_POOL_MIN)
+            maxconn = pool_config.get("max", DEFAULT_POOL_MAX)
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn, maxconn, **_connect_args(config))
+            # ThreadedConnectionPool raises when exhausted; the semaphore
+            # makes extra threads wait for a connection instead
+            _pool_slots = threading.BoundedSemaphore(maxconn)
+            logging.info("Created connection pool (min %d, max %d)" % (
+                minconn, maxconn))
+        return _pool
+
+
+def close_pool():
+    """
+    Close all connections in the shared connection pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            logging.info("Closed connection pool")
+        _pool = None
+
+
+def _is_healthy(connection):
+    """
+    Check that a connection taken from the pool is still usable.
+    """
+    if connection.closed:
+        return False
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        connection.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def pooled_connection():
+    """
+    Check a connection out of the shared pool for the duration of a with
+    block.
+
+    The connection is health-checked before it is handed out; broken
+    connections are discarded and replaced. On leaving the block, the
+    transaction is committed (or rolled back if an exception was raised) and
+    the connection is returned to the pool. If all connections are in use,
+    the calling thread waits for one to be returned.
+
+    Yields
+    ------
+    connection:
+        A psycopg2 connection, for the exclusive use of the calling thread.
+    """
+    pool = get_pool()
+    slots = _pool_slots
+    slots.acquire()
+    try:
+        connection = pool.getconn()
+        while not _is_healthy(connection):
+            logging.warning("Discarding broken pooled connection")
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+        try:
+            yield connection
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        else:
+            connection.commit()
+        finally:
+            pool.putconn(connection, close=bool(connection.closed))
+    finally:
+        slots.release()
+
+
+@contextlib.contextmanager
+def pooled_cursor():
+    """
+    Get a cursor on a pooled connection for the duration of a with block.
+
+    Each call (and so each thread) gets its own connection and cursor; see
+    pooled_connection for the transaction handling.
+
+    Yields
+    ------
+    cursor:
+        A psycopg2 cursor.
+    """
+    with pooled_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
@@ -1,12 +1,293 @@
+import itertools
 import logging
 import os
+import re
+import time
+import numpy as np
 import pandas as pd
+import psycopg2.extensions
 
+from instrument import measure
 
-def create_tables(cursor, tables_dir):
+
+# Table spec directive lines, of the form "# @keyword arguments"
+DIRECTIVE_REGEX = re.compile(r'^#\s*@(?P<keyword>\w+)\s*(?P<args>.*?)\s*$')
+
+# Arguments of "# @index <name> [unique] <method> (<columns>) [where <pred>]"
+INDEX_REGEX = re.compile(
+    r'^(?P<name>\w+)\s+(?P<unique>unique\s+)?(?P<method>\w+)\s*'
+    r'\((?P<columns>[^)]*)\)\s*(where\s+(?P<where>.+))?$', re.IGNORECASE)
+
+# Arguments of "# @partition <range|list> (<columns>)"
+PARTITION_REGEX = re.compile(r'^(?P<method>range|list)\s*\((?P<columns>[^)]*)\)$',
+                             re.IGNORECASE)
+
+# Arguments of "# @part <name> <bounds>", where bounds is one of
+# "from (...) to (...)", "in (...)" or "default"
+PART_REGEX = re.compile(r'^(?P<name>\w+)\s+(?P<bounds>.+)$')
+
+# Change tracking ("# @track_changes"): tracked tables get a CHANGE_COLUMN,
+# set from the shared CHANGE_SEQUENCE whenever a row is inserted or changed.
+# The writing transaction is given its transaction id before it draws from
+# the sequence (see extract.extract_changed_since).
+CHANGE_COLUMN = "change_seq"
+CHANGE_SEQUENCE = "change_seq"
+CHANGE_FUNCTION = "track_change"
+CHANGE_NEXT_FUNCTION = "next_change"
+CHANGE_SETUP_STRINGS = [
+    "CREATE SEQUENCE IF NOT EXISTS %s;" % CHANGE_SEQUENCE,
+    "CREATE OR REPLACE FUNCTION %s() RETURNS bigint AS $$ "
+    "BEGIN PERFORM txid_current(); RETURN nextval('%s'); END; "
+    "$$ LANGUAGE plpgsql;" % (CHANGE_NEXT_FUNCTION, CHANGE_SEQUENCE),
+    "CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$ "
+    "BEGIN NEW.%s := %s(); RETURN NEW; END; "
+    "$$ LANGUAGE plpgsql;" % (CHANGE_FUNCTION, CHANGE_COLUMN,
+                              CHANGE_NEXT_FUNCTION),
+]
+
+# Table change stamps: every table gets statement-level triggers which append
+# a row (the table name, and a new value from TABLE_CHANGE_SEQUENCE) to
+# TABLE_CHANGE_TABLE, within the writing transaction, whenever a statement
+# changes at least one of its rows. Writers only ever insert stamps, so
+# concurrent writers never wait on each other's stamps. Each stamp counts one
+# change; cache.table_marker uses the latest stamp and the total count of
+# changes of each table (which, unlike the latest stamp, also changes when a
+# transaction holding an earlier stamp commits late) to detect changes to its
+# content. prune_table_changes folds the superseded stamps into the latest.
+TABLE_CHANGE_TABLE = "table_change"
+TABLE_CHANGE_SEQUENCE = "table_change_seq"
+TABLE_CHANGE_FUNCTION = "stamp_table_change"
+# The events stamped, and the transition table (if any) holding the rows
+# changed by the statement
+TABLE_CHANGE_EVENTS = [("insert", "NEW TABLE AS new_rows"),
+                       ("update", "NEW TABLE AS new_rows"),
+                       ("delete", "OLD TABLE AS old_rows"),
+                       ("truncate", None)]
+TABLE_CHANGE_STRING = (
+    "INSERT INTO %s (table_name, stamp) VALUES (%%s, nextval('%s'))" % (
+        TABLE_CHANGE_TABLE, TABLE_CHANGE_SEQUENCE))
+TABLE_CHANGE_SETUP_STRINGS = [
+    "CREATE SEQUENCE IF NOT EXISTS %s;" % TABLE_CHANGE_SEQUENCE,
+    "CREATE TABLE IF NOT EXISTS %s (table_name text not null, "
+    "stamp bigint not null, changes bigint not null default 1);" % (
+        TABLE_CHANGE_TABLE, ),
+    # Earlier versions kept a single (primary keyed) row per table
+    "ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s_pkey;" % (
+        TABLE_CHANGE_TABLE, TABLE_CHANGE_TABLE),
+    "ALTER TABLE %s ADD COLUMN IF NOT EXISTS changes bigint not null "
+    "default 1;" % TABLE_CHANGE_TABLE,
+    "CREATE INDEX IF NOT EXISTS %s_table_name_stamp_idx "
+    "ON %s (table_name, stamp);" % (TABLE_CHANGE_TABLE, TABLE_CHANGE_TABLE),
+    # The triggers pass the name of the table to stamp, so that the TRUNCATE
+    # triggers of partitions stamp their partitioned table; triggers created
+    # by earlier versions pass nothing, and have no transition tables
+    "CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$ "
+    "BEGIN "
+    "IF TG_NARGS = 0 THEN %s; "
+    "ELSIF TG_OP = 'TRUNCATE' THEN %s; "
+    "ELSIF TG_OP = 'DELETE' THEN "
+    "IF EXISTS (SELECT 1 FROM old_rows) THEN %s; END IF; "
+    "ELSIF EXISTS (SELECT 1 FROM new_rows) THEN %s; "
+    "END IF; "
+    "RETURN NULL; END; "
+    "$$ LANGUAGE plpgsql;" % (
+        (TABLE_CHANGE_FUNCTION, TABLE_CHANGE_STRING % "TG_TABLE_NAME") +
+        (TABLE_CHANGE_STRING % "TG_ARGV[0]", ) * 3),
+]
+
+
+def _table_change_strings(table_name, partitions=None):
+    """
+    Create the triggers stamping a table in TABLE_CHANGE_TABLE.
+
+    Parameters
+    ----------
+    table_name:
+        The name of the table.
+    partitions:
+        List of the names of the table's partitions, if it is partitioned.
+        Partitioned tables cannot have TRUNCATE triggers, so the partitions
+        get them instead. Defaults to None.
+
+    Returns
+    -------
+    strings:
+        List of statements creating the triggers.
+    """
+    strings = []
+    for event, transition in TABLE_CHANGE_EVENTS:
+        if event == "truncate" and partitions is not None:
+            targets = partitions
+        else:
+            targets = [table_name]
+        for target in targets:
+            strings.append(
+                "CREATE TRIGGER %s_%s_%s AFTER %s ON %s %s"
+                "FOR EACH STATEMENT EXECUTE PROCEDURE %s('%s');" % (
+                    target, TABLE_CHANGE_FUNCTION, event, event.upper(),
+                    target, "REFERENCING %s " % transition if transition
+                    else "", TABLE_CHANGE_FUNCTION, table_name))
+    return strings
+
+
+def prune_table_changes(cursor):
+    """
+    Fold the superseded stamps of each table in TABLE_CHANGE_TABLE into its
+    latest stamp, which keeps their count of changes, so that the latest
+    stamp and the total count (and so cache.table_marker) are unchanged.
+
+    Stamps of transactions which are still in progress are not seen, and so
+    are kept, and counted once they commit. Concurrent prunes wait for each
+    other, but not for writers.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor to provide access to the database.
+
+    Returns
+    -------
+    removed:
+        The number of stamps removed.
+    """
+    if cursor is None:
+        return 0
+    cursor.execute("LOCK TABLE %s IN SHARE UPDATE EXCLUSIVE MODE" % (
+        TABLE_CHANGE_TABLE, ))
+    cursor.execute("WITH latest AS (SELECT table_name, max(stamp) AS stamp "
+                   "FROM %s GROUP BY table_name), "
+                   "pruned AS (DELETE FROM %s t USING latest l "
+                   "WHERE t.table_name = l.table_name AND t.stamp < l.stamp "
+                   "RETURNING t.table_name, t.changes), "
+                   "folded AS (SELECT table_name, sum(changes) AS changes, "
+                   "count(*) AS removed FROM pruned GROUP BY table_name) "
+                   "UPDATE %s t SET changes = t.changes + f.changes "
+                   "FROM folded f JOIN latest l USING (table_name) "
+                   "WHERE t.table_name = f.table_name AND t.stamp = l.stamp "
+                   "RETURNING f.removed" % ((TABLE_CHANGE_TABLE, ) * 3))
+    removed = sum(row[0] for row in cursor.fetchall())
+    logging.debug("Pruned %d table change stamps" % removed)
+    return removed
+
+
+def _read_directives(table_file):
+    """
+    Read the directive comment lines (e.g. index and partition declarations)
+    from a table spec file.
+
+    Parameters
+    ----------
+    table_file:
+        The path to the table spec file.
+
+    Returns
+    -------
+    directives:
+        List of (keyword, arguments) tuples, in file order.
+    """
+    directives = []
+    with open(table_file) as fileobj:
+        for line in fileobj:
+            match = DIRECTIVE_REGEX.match(line.strip())
+            if match:
+                directives.append((match.group("keyword").lower(),
+                                   match.group("args")))
+    return directives
+
+
+def _directive_strings(table_name, directives):
+    """
+    Convert the directives of a table spec into SQL.
+
+    Parameters
+    ----------
+    table_name:
+        The name of the table the directives belong to.
+    directives:
+        List of (keyword, arguments) tuples, as returned by _read_directives.
+
+    Returns
+    -------
+    partition_string:
+        The PARTITION BY clause to append to the CREATE TABLE statement, or
+        an empty string if the table is not partitioned.
+    part_strings:
+        List of statements creating the table partitions.
+    index_strings:
+        List of statements creating the secondary indexes.
+    """
+    partition_string = ""
+    part_strings = []
+    index_strings = []
+    for keyword, args in directives:
+        if keyword == "index":
+            match = INDEX_REGEX.match(args)
+            if not match:
+                raise ValueError("Invalid index declaration for table %s: %s"
+                                 % (table_name, args))
+            string = "CREATE %sINDEX %s ON %s USING %s (%s)" % (
+                "UNIQUE " if match.group("unique") else "",
+                match.group("name"), table_name, match.group("method"),
+                match.group("columns"))
+            if match.group("where"):
+                string += " WHERE %s" % match.group("where")
+            index_strings.append(string + ";")
+        elif keyword == "partition":
+            match = PARTITION_REGEX.match(args)
+            if not match:
+                raise ValueError("Invalid partition declaration for table %s:"
+                                 " %s" % (table_name, args))
+            partition_string = " PARTITION BY %s (%s)" % (
+                match.group("method").upper(), match.group("columns"))
+        elif keyword == "track_changes":
+            # Handled by create_tables, which adds the change column
+            index_strings.append(
+                "CREATE INDEX %s_%s_idx ON %s USING btree (%s);" % (
+                    table_name, CHANGE_COLUMN, table_name, CHANGE_COLUMN))
+        elif keyword == "part":
+            match = PART_REGEX.match(args)
+            if not match:
+                raise ValueError("Invalid partition for table %s: %s" % (
+                    table_name, args))
+            bounds = match.group("bounds")
+            part_strings.append("CREATE TABLE %s PARTITION OF %s %s;" % (
+                match.group("name"), table_name,
+                "DEFAULT" if bounds.upper() == "DEFAULT"
+                else "FOR VALUES %s" % bounds))
+        else:
+            raise ValueError("Unknown directive @%s for table %s" % (
+                keyword, table_name))
+    if part_strings and not partition_string:
+        raise ValueError("Table %s declares partitions, but no @partition"
+                         % table_name)
+    return partition_string, part_strings, index_strings
+
+
+def create_tables(cursor, tables_dir, deferred=None):
     """
     Create database tables as per the configuration file(s) in tables_dir.
 
+    As well as the column table, each configuration file may contain
+    directive comment lines declaring secondary indexes and partitioning:
+
+        # @index <name> [unique] <method> (<columns>) [where <predicate>]
+        # @partition <range|list> (<columns>)
+        # @part <name> from (<lower>) to (<upper>)
+        # @part <name> in (<values>)
+        # @part <name> default
+        # @track_changes
+
+    A table declaring @track_changes gets an extra CHANGE_COLUMN, which is
+    set from a database-wide sequence when each row is inserted, and by a
+    trigger whenever a row is changed, so that extract_changed_since can read
+    only the rows changed since a given sequence value. As the column has
+    the same name in every tracked table, tables which are NATURAL JOINed
+    together cannot both be tracked.
+
+    Every table also gets triggers which stamp the table in the
+    TABLE_CHANGE_TABLE whenever a statement changes its rows (see
+    cache.table_marker).
+
     Parameters
     ----------
     cursor:
@@ -14,10 +295,19 @@ def create_tables(cursor, tables_dir):
     tables_dir:
         The (relative or absolute) path to the directory containing the
         configuration file(s) to be converted into database tables.
+    deferred:
+        Optional list. If given, the tables are created with only their
+        primary keys (and partitions); the statements adding the unique and
+        foreign key constraints and the secondary indexes are appended to
+        deferred instead, so that they can be built in bulk by
+        build_deferred once the tables have been loaded. Defaults to None,
+        which creates everything up front.
 
     Returns
     -------
-    Nil. Database tables created using the cursor.
+    tables:
+        The names of the tables, in the order they were (or, if cursor is
+        None, would have been) created.
     """
 
     logging.info("Creating tables declare in %s" % tables_dir)
@@ -29,6 +319,9 @@ def create_tables(cursor, tables_dir):
     logging.debug("Found table files: %s" % names)
     exec_strings = []
     tables = []
+    unique_strings = []
+    index_strings = []
+    fk_strings = []
     for table_file in names:
         table_name = table_file.split(".")[
             0
@@ -56,24 +349,263 @@ def create_tables(cursor, tables_dir):
                 pks.append(col_name)
             col_ref = column["foreign_key_table"].lower()
             if column["unique"].upper() == "TRUE":
-                string += "UNIQUE "
+                if deferred is None:
+                    string += "UNIQUE "
+                else:
+                    unique_strings.append(
+                        "ALTER TABLE %s ADD UNIQUE (%s);" % (
+                            table_name, col_name))
             if col_ref != "none":
-                string += "REFERENCES %s (%s) " % (col_ref, col_name)
+                if deferred is None:
+                    string += "REFERENCES %s (%s) " % (col_ref, col_name)
+                else:
+                    fk_strings.append(
+                        "ALTER TABLE %s ADD FOREIGN KEY (%s) "
+                        "REFERENCES %s (%s);" % (
+                            table_name, col_name, col_ref, col_name))
             string += ", "
+        directives = _read_directives(tables_dir + os.sep + table_file)
+        tracked = ("track_changes", "") in directives
+        if tracked:
+            string += "%s bigint not null default %s(), " % (
+                CHANGE_COLUMN, CHANGE_NEXT_FUNCTION)
         string += "PRIMARY KEY (%s)" % ",".join(pks)
-        string += " );"
+        string += " )"
         assert len(pks) > 0, "Table %s has no primary keys!" % table_name
+        partition_string, part_strings, table_indexes = _directive_strings(
+            table_name, directives)
+        string += partition_string + ";"
+        if tracked:
+            # Only bump the sequence for updates which change something
+            part_strings.append(
+                "CREATE TRIGGER %s_%s BEFORE UPDATE ON %s FOR EACH ROW "
+                "WHEN (OLD.* IS DISTINCT FROM NEW.*) "
+                "EXECUTE PROCEDURE %s();" % (
+                    table_name, CHANGE_FUNCTION, table_name,
+                    CHANGE_FUNCTION))
+        part_strings += _table_change_strings(
+            table_name,
+            [PART_REGEX.match(args).group("name")
+             for keyword, args in directives if keyword == "part"]
+            if partition_string else None)
         logging.debug("Statement is %s" % string)
-        exec_strings.append(string)
+        for extra in part_strings:
+            logging.debug("Statement is %s" % extra)
+        if deferred is None:
+            part_strings += table_indexes
+        else:
+            index_strings += table_indexes
+        exec_strings.append((CHANGE_SETUP_STRINGS if tracked else [])
+                            + [string] + part_strings)
         tables.append(table_name)
 
     # Currently all tables are created at once.
     if cursor is not None:
-        for s, t in zip(exec_strings, tables):
-            logging.info("Creating table %s" % t)
+        for s in TABLE_CHANGE_SETUP_STRINGS:
             cursor.execute(s)
+        for statements, t in zip(exec_strings, tables):
+            logging.info("Creating table %s" % t)
+            for s in statements:
+                cursor.execute(s)
         logging.info("Created all tables")
 
+    if deferred is not None:
+        # Unique constraints first, as foreign keys may depend on them
+        for extra in unique_strings + index_strings + fk_strings:
+            logging.debug("Deferred statement is %s" % extra)
+        deferred.extend(unique_strings + index_strings + fk_strings)
+
+    return tables
+
+
+def build_deferred(cursor, deferred, tables):
+    """
+    Build the constraints and indexes deferred by create_tables, and update
+    the planner statistics, once the tables have been loaded.
+
+    Adding a foreign key constraint validates it against all existing rows
+    in a single pass, rather than checking each row as it is inserted.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor to provide access to the database.
+    deferred:
+        The list of deferred statements populated by create_tables.
+    tables:
+        List of the names of the tables to ANALYZE.
+
+    Returns
+    -------
+    Nil. Constraints and indexes built using the cursor.
+    """
+    start = time.time()
+    for string in deferred:
+        logging.debug(string)
+        if cursor is not None:
+            cursor.execute(string)
+    for table in tables:
+        logging.debug("ANALYZE %s" % table)
+        if cursor is not None:
+            cursor.execute("ANALYZE %s" % table)
+    logging.info("Built %d deferred constraints/indexes and analyzed %d tables"
+                 " in %.2f s" % (len(deferred), len(tables),
+                                 time.time() - start))
+
+
+def create_views(cursor, views_dir):
+    """
+    Create materialized views as per the definition file(s) in views_dir.
+
+    Each file holds the SELECT query defining the view, which is named after
+    the file in the same way as the table spec files (e.g.
+    1_science_view.sql defines science_view). Comment lines in the file
+    may declare indexes on the view, as for tables:
+
+        # @index <name> [unique] <method> (<columns>) [where <predicate>]
+
+    The views are populated when they are created, so this should be called
+    once the tables they read from have been loaded; the indexes are then
+    built on the populated views.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor to provide access to the database.
+    views_dir:
+        The (relative or absolute) path to the directory containing the view
+        definition file(s).
+
+    Returns
+    -------
+    views:
+        The names of the views, in the order they were (or, if cursor is
+        None, would have been) created.
+    """
+    logging.info("Creating materialized views declared in %s" % views_dir)
+
+    names = sorted(os.listdir(views_dir),
+                   key=lambda x: int(x.split("_")[0]))
+    views = []
+    start = time.time()
+    for view_file in names:
+        view_name = view_file.split(".")[
+            0
+            ].partition("_")[2].replace(" ", "_").lower()
+        with open(views_dir + os.sep + view_file) as fileobj:
+            query = "\n".join(line.rstrip() for line in fileobj
+                              if line.strip()
+                              and not line.strip().startswith("#"))
+        partition_string, part_strings, index_strings = _directive_strings(
+            view_name, _read_directives(views_dir + os.sep + view_file))
+        if partition_string or part_strings:
+            raise ValueError("View %s cannot be partitioned" % view_name)
+        string = "CREATE MATERIALIZED VIEW %s AS %s;" % (
+            view_name, query.strip().rstrip(";"))
+        for statement in [string] + index_strings:
+            logging.debug("Statement is %s" % statement)
+            if cursor is not None:
+                cursor.execute(statement)
+        if cursor is not None:
+            cursor.execute("ANALYZE %s" % view_name)
+        views.append(view_name)
+    logging.info("Created %d materialized views in %.2f s" % (
+        len(views), time.time() - start))
+    return views
+
+
+def refresh_views(cursor, views=None, concurrently=False):
+    """
+    Refresh materialized views, e.g. once the tables they read from have
+    been updated.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor to provide access to the database.
+    views:
+        List of view names. Defaults to None, which refreshes all of the
+        materialized views in the current schema.
+    concurrently:
+        Boolean. If True, the views are refreshed without locking out
+        concurrent readers (which requires each view to have a unique
+        index). Defaults to False.
+
+    Returns
+    -------
+    views:
+        The names of the views refreshed.
+    """
+    if cursor is None:
+        return views or []
+    if views is None:
+        cursor.execute("SELECT matviewname FROM pg_matviews "
+                       "WHERE schemaname = current_schema() "
+                       "ORDER BY matviewname")
+        views = [row[0] for row in cursor.fetchall()]
+    start = time.time()
+    for view in views:
+        string = "REFRESH MATERIALIZED VIEW %s%s" % (
+            "CONCURRENTLY " if concurrently else "", view)
+        logging.debug(string)
+        cursor.execute(string)
+        cursor.execute("ANALYZE %s" % view)
+        # Materialized views cannot have triggers, so are stamped here
+        cursor.execute(TABLE_CHANGE_STRING, (view, ))
+    logging.info("Refreshed %d materialized views in %.2f s" % (
+        len(views), time.time() - start))
+    return views
+
+
+def drop_tables(cursor, tables):
+    """
+    Drop database tables, e.g. to undo a partially completed upgrade.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor to provide access to the database.
+    tables:
+        List of table names, in the order they were created. Tables are
+        dropped in reverse order; tables which do not exist are ignored.
+
+    Returns
+    -------
+    Nil. Database tables dropped using the cursor.
+    """
+    for table in reversed(tables):
+        string = "DROP TABLE IF EXISTS %s CASCADE" % table
+        logging.debug(string)
+        if cursor is not None:
+            cursor.execute(string)
+
+
+def existing_tables(cursor, tables):
+    """
+    Find which of a list of tables already exist in the database.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor to provide access to the database.
+    tables:
+        List of table names.
+
+    Returns
+    -------
+    existing:
+        The names of the tables in tables which exist, in the same order.
+        If cursor is None, no tables exist.
+    """
+    if cursor is None:
+        return []
+    existing = []
+    for table in tables:
+        cursor.execute("SELECT to_regclass(%s)", (table, ))
+        if cursor.fetchone()[0] is not None:
+            existing.append(table)
+    return existing
+
 
 def insert_many_rows(cursor, table, values, columns=None, batch=100):
     """
@@ -115,6 +647,7 @@ def insert_many_rows(cursor, table, values, columns=None, batch=100):
                   + "... total of %d elements" % len(values))
 
     if cursor is not None:
+        start = time.time()
         while index < len(values):
             end = index + batch
             if end > len(values):
@@ -122,7 +655,198 @@ def insert_many_rows(cursor, table, values, columns=None, batch=100):
             rows = values[index:end]
             index = end
             current_string = string % ",".join(["%s"] * len(rows))
-            cursor.execute(current_string, rows)
+            with measure(cursor, current_string, rows) as m:
+                cursor.execute(current_string, rows)
+                m.rows = len(rows)
+                m.bytes = len(cursor.query)
+        elapsed = time.time() - start
+        logging.info("Inserted %d rows into %s in %.2f s (%.0f rows/s)" % (
+            len(values), table, elapsed,
+            len(values) / elapsed if elapsed > 0 else float("inf")))
+
+
+def _copy_format_value(value):
+    """
+    Format a single value for the PostgreSQL COPY text format.
+
+    Parameters
+    ----------
+    value:
+        The value to be formatted. None is written as NULL, booleans as t/f,
+        and floats with full (repr) precision.
+
+    Returns
+    -------
+    formatted:
+        The string representation of value, with the COPY special characters
+        (backslash, tab, newline and carriage return) escaped.
+    """
+    if value is None:
+        return "\\N"
+    # bool must be checked before the numeric types, as it subclasses int
+    if isinstance(value, (bool, np.bool_)):
+        return "t" if value else "f"
+    if isinstance(value, float):
+        return repr(float(value))
+    if isinstance(value, bytes) and not isinstance(value, str):
+        value = value.decode("utf-8")
+    value = str(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class _CopyRowStream(object):
+    """
+    File-like object which renders rows into COPY text format on demand.
+
+    psycopg2's copy_expert reads from this object in fixed-size blocks, so
+    only a block's worth of rows is ever held as formatted text; the full
+    COPY payload is never built as a single string.
+    """
+
+    def __init__(self, rows, batch):
+        self._rows = iter(rows)
+        self._batch = batch
+        self._buffer = ""
+        self.rows = 0
+        self.bytes = 0
+
+    def _fill(self, size):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            lines = []
+            for row in self._rows:
+                lines.append("\t".join(
+                    [_copy_format_value(v) for v in row]) + "\n")
+                if len(lines) >= self._batch:
+                    break
+            if not lines:
+                break
+            self.rows += len(lines)
+            chunk = "".join(lines)
+            chunks.append(chunk)
+            length += len(chunk)
+        self._buffer = "".join(chunks)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes += len(data)
+        return data
+
+
+def copy_many_rows(cursor, table, values, columns=None, batch=10000):
+    """
+    Insert multiple rows into a database table using COPY FROM STDIN.
+
+    This is a drop-in replacement for insert_many_rows intended for bulk
+    loading. Rows are streamed to the server in a single COPY, with only
+    `batch` rows rendered into the in-memory buffer at any one time.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    table:
+        The name of the table to be manipulated.
+    values:
+        The values to be added to the table, as an iterable of iterables. In
+        each sub-iterable, values should be in the order of the database
+        columns, unless the columns argument is also passed; in that case,
+        values should be in order corresponding to the columns parameter.
+        values may be a generator, in which case it is only consumed as the
+        rows are sent to the database.
+    columns:
+        List of column names that correspond to the ordering of values. Can also
+        be used to restrict the number of columns to write to (i.e. allow
+        default table values for columns if not required). Defaults to None,
+        which assumes that you wish to write information to all columns.
+    batch:
+        Integer, denoting how many rows to format into the buffer in each
+        pass. Defaults to 10000.
+
+    Returns
+    -------
+    rows:
+        The number of rows written to the table. The load rate (rows/second)
+        is reported via logging.info.
+    """
+
+    string = "COPY %s %sFROM STDIN" % (
+        table,
+        "" if columns is None else "(" + ", ".join(columns) + ") ",
+    )
+    logging.debug("COPY ROW INSERT: " + string)
+
+    if cursor is None:
+        return 0
+
+    stream = _CopyRowStream(values, batch)
+    start = time.time()
+    with measure(cursor, string) as m:
+        cursor.copy_expert(string, stream)
+        m.rows = stream.rows
+        m.bytes = stream.bytes
+    elapsed = time.time() - start
+    logging.info("Copied %d rows into %s in %.2f s (%.0f rows/s)" % (
+        stream.rows, table, elapsed,
+        stream.rows / elapsed if elapsed > 0 else float("inf")))
+    return stream.rows
+
+
+def _iter_column_rows(arrays, batch):
+    """
+    Generate row tuples from a list of column arrays, converting the columns
+    to Python scalars one batch at a time.
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    length = len(arrays[0]) if arrays else 0
+    for a in arrays:
+        if len(a) != length:
+            raise ValueError("All column arrays must have the same length")
+    for start in range(0, length, batch):
+        end = min(start + batch, length)
+        for row in zip(*[a[start:end].tolist() for a in arrays]):
+            yield row
+
+
+def copy_columns(cursor, table, arrays, columns=None, batch=10000):
+    """
+    Insert column arrays into a database table using COPY FROM STDIN.
+
+    This is the columnar counterpart of copy_many_rows: rather than a list of
+    rows, the data are passed as one array per column, which avoids having to
+    build a Python list for every row of the input catalogue.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    table:
+        The name of the table to be manipulated.
+    arrays:
+        List of equal-length 1D arrays (or array-likes), one per column. Arrays
+        should be in the order of the database columns, unless the columns
+        argument is also passed; in that case, arrays should be in order
+        corresponding to the columns parameter.
+    columns:
+        List of column names that correspond to the ordering of arrays.
+        Defaults to None, which assumes that you wish to write information
+        to all columns.
+    batch:
+        Integer, denoting how many rows to convert and format in each pass.
+        Defaults to 10000.
+
+    Returns
+    -------
+    rows:
+        The number of rows written to the table.
+    """
+    return copy_many_rows(cursor, table, _iter_column_rows(arrays, batch),
+                          columns=columns, batch=batch)
 
 
 def insert_row(cursor, table, values, columns=None):
@@ -163,10 +887,229 @@ def insert_row(cursor, table, values, columns=None):
         )
     logging.debug(string + " with values " + str(values))
     if cursor is not None:
-        cursor.execute(string, values)
+        with measure(cursor, string, values) as m:
+            cursor.execute(string, values)
+            m.rows = 1
+            m.bytes = len(cursor.query)
         logging.debug("Insert successful")
 
 
+# Used to give each staging table a unique name within the session
+_staging_counter = itertools.count()
+
+
+def _create_staging_table(cursor, table, columns):
+    """
+    Create an empty temporary table with the given columns of table (with
+    the same types, but none of the constraints). The caller drops it with
+    _drop_staging_table once done (the table is not dropped on commit, as on
+    an autocommit connection that would be straight after its creation).
+
+    Returns
+    -------
+    staging:
+        The name of the temporary table.
+    """
+    staging = "_staging_%s_%d" % (table, next(_staging_counter))
+    cursor.execute("CREATE TEMPORARY TABLE %s AS "
+                   "SELECT %s FROM %s LIMIT 0" % (
+                       staging, ", ".join(columns), table))
+    return staging
+
+
+def _drop_staging_table(cursor, staging):
+    """
+    Drop a temporary table created by _create_staging_table, unless the
+    transaction has failed (in which case rolling it back drops the table).
+    """
+    if cursor.connection.get_transaction_status() != \
+            psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        cursor.execute("DROP TABLE IF EXISTS %s" % staging)
+
+
+def update_many_rows(cursor, table, values, key_columns, columns,
+                     increment=None, batch=10000):
+    """
+    Update multiple rows of a database table in a single statement.
+
+    The new values are streamed with COPY into a temporary staging table,
+    which is then joined to the target table by an UPDATE ... FROM. This
+    happens within the cursor's current transaction, so the update is only
+    made permanent when the caller commits.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    table:
+        The name of the table to be manipulated.
+    values:
+        The key and new values for each row to be updated, as an iterable of
+        iterables. Each sub-iterable holds the values of key_columns followed
+        by the values of columns. Each key should appear only once.
+    key_columns:
+        List of column names identifying the rows to update (typically the
+        primary key).
+    columns:
+        List of column names to update.
+    increment:
+        List of column names (a subset of columns) whose values should be
+        added to the existing values, rather than replacing them, e.g.
+        ['repeats'] with values of 1 to bump the repeat count. Defaults to
+        None.
+    batch:
+        Integer, denoting how many rows to format into the COPY buffer in
+        each pass. Defaults to 10000.
+
+    Returns
+    -------
+    rows:
+        The number of table rows updated.
+    """
+    if increment is None:
+        increment = []
+    for column in increment:
+        if column not in columns:
+            raise ValueError("Cannot increment %s, which is not one of the "
+                             "updated columns" % column)
+
+    string = "UPDATE %s t SET %s FROM %%s u WHERE %s" % (
+        table,
+        ", ".join(["%s = t.%s + u.%s" % (c, c, c) if c in increment
+                   else "%s = u.%s" % (c, c) for c in columns]),
+        " AND ".join(["t.%s = u.%s" % (c, c) for c in key_columns]),
+    )
+    logging.debug("MANY ROW UPDATE: " + string)
+
+    if cursor is None:
+        return 0
+
+    start = time.time()
+    staging = _create_staging_table(cursor, table, key_columns + columns)
+    try:
+        staged = copy_many_rows(cursor, staging, values,
+                                columns=key_columns + columns, batch=batch)
+        # Give the planner real statistics for the join
+        cursor.execute("ANALYZE %s" % staging)
+        string = string % staging
+        with measure(cursor, string) as m:
+            cursor.execute(string)
+            m.rows = cursor.rowcount
+        rows = cursor.rowcount
+    finally:
+        _drop_staging_table(cursor, staging)
+    elapsed = time.time() - start
+    logging.info("Updated %d rows (of %d given) in %s in %.2f s (%.0f rows/s)"
+                 % (rows, staged, table, elapsed,
+                    staged / elapsed if elapsed > 0 else float("inf")))
+    return rows
+
+
+def upsert_many_rows(cursor, table, values, key_columns, columns,
+                     update=False, batch=10000):
+    """
+    Insert multiple rows into a database table, skipping (or updating) rows
+    whose keys already exist.
+
+    This is the idempotent counterpart of copy_many_rows: the rows are
+    streamed with COPY into a temporary staging table, and then moved into
+    the table by an INSERT ... ON CONFLICT, so that re-loading data which
+    is already (partially) present does not fail on key conflicts.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    table:
+        The name of the table to be manipulated.
+    values:
+        The values to be added to the table, as an iterable of iterables, in
+        the order of columns.
+    key_columns:
+        List of the column names of a primary key or unique constraint of
+        table, used to detect conflicting rows. These must also appear in
+        columns.
+    columns:
+        List of column names that correspond to the ordering of values.
+    update:
+        Boolean. If True, conflicting rows are updated with the new values
+        (ON CONFLICT DO UPDATE); if False, they are left as they are (ON
+        CONFLICT DO NOTHING). Defaults to False. If a key appears more than
+        once in values, only its first row is inserted if update is False,
+        and only its last row is used if update is True.
+    batch:
+        Integer, denoting how many rows to format into the COPY buffer in
+        each pass. Defaults to 10000.
+
+    Returns
+    -------
+    rows:
+        The number of rows inserted (or updated, if update is True).
+    """
+    lower_columns = [c.lower() for c in columns]
+    for column in key_columns:
+        if column.lower() not in lower_columns:
+            raise ValueError("Key column %s is not one of the columns "
+                             "written" % column)
+    updates = [c for c in columns
+               if c.lower() not in [k.lower() for k in key_columns]]
+    if update and updates:
+        action = "DO UPDATE SET %s" % ", ".join(
+            ["%s = EXCLUDED.%s" % (c, c) for c in updates])
+        # A row may only be updated once per statement, so repeated keys
+        # are reduced to their last staged (i.e. given) row
+        select = ("SELECT DISTINCT ON (%s) %s FROM %%s "
+                  "ORDER BY %s, ctid DESC" % (
+                      ", ".join(key_columns), ", ".join(columns),
+                      ", ".join(key_columns)))
+    else:
+        action = "DO NOTHING"
+        select = "SELECT %s FROM %%s" % ", ".join(columns)
+    string = "INSERT INTO %s (%s) %s ON CONFLICT (%s) %s" % (
+        table, ", ".join(columns), select, ", ".join(key_columns), action)
+    logging.debug("MANY ROW UPSERT: " + string)
+
+    if cursor is None:
+        return 0
+
+    start = time.time()
+    staging = _create_staging_table(cursor, table, columns)
+    try:
+        staged = copy_many_rows(cursor, staging, values, columns=columns,
+                                batch=batch)
+        string = string % staging
+        with measure(cursor, string) as m:
+            cursor.execute(string)
+            m.rows = cursor.rowcount
+        rows = cursor.rowcount
+    finally:
+        _drop_staging_table(cursor, staging)
+    elapsed = time.time() - start
+    logging.info("Upserted %d rows (of %d given) into %s in %.2f s "
+                 "(%.0f rows/s)" % (
+                     rows, staged, table, elapsed,
+                     staged / elapsed if elapsed > 0 else float("inf")))
+    return rows
+
+
+def upsert_columns(cursor, table, arrays, key_columns, columns,
+                   update=False, batch=10000):
+    """
+    Insert column arrays into a database table, skipping (or updating) rows
+    whose keys already exist.
+
+    This is the columnar counterpart of upsert_many_rows; see that function
+    and copy_columns for details of the parameters.
+
+    Returns
+    -------
+    rows:
+        The number of rows inserted (or updated, if update is True).
+    """
+    return upsert_many_rows(cursor, table, _iter_column_rows(arrays, batch),
+                            key_columns, columns, update=update, batch=batch)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     conn = None
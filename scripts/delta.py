@@ -0,0 +1,146 @@
+import logging
+
+import numpy as np
+
+from collection import TargetCollection
+from extract import extract_changed_since
+
+
+class DeltaCatalog(object):
+    """
+    An in-memory copy of a change-tracked table (or join), kept up to date by
+    applying only the rows changed since the last sync.
+
+    The rows are held in a numpy structured array, sorted by key. On each
+    sync, changed rows already held are overwritten in place, and new rows
+    are merged in.
+
+    Parameters
+    ----------
+    table:
+        The name of the tracked table, or a list of table names to be
+        NATURAL JOINed, as for extract.extract_changed_since.
+    key:
+        The name of the column uniquely identifying each row, e.g.
+        'target_id'.
+    conditions:
+        Conditions rows must satisfy, as for extract.extract_from. Note that
+        rows which stop satisfying the conditions are not removed. Defaults
+        to None.
+    columns:
+        List of column names to hold; key and the change column are always
+        included. Defaults to None, which holds all columns.
+    change_column:
+        The name of the change sequence column. Defaults to "change_seq".
+    """
+
+    def __init__(self, table, key, conditions=None, columns=None,
+                 change_column="change_seq"):
+        self.table = table
+        self.key = key
+        self.conditions = conditions
+        if columns is not None and key not in columns:
+            columns = [key] + list(columns)
+        self.columns = columns
+        self.change_column = change_column
+        self.array = None
+        # See extract.extract_changed_since
+        self.watermark = 0
+
+    def __len__(self):
+        return 0 if self.array is None else len(self.array)
+
+    def sync(self, cursor):
+        """
+        Apply the changes made since the last sync (or, on the first call,
+        load the whole catalog). Rows changed by transactions which were
+        still in flight at the last sync are read (and applied) again, so
+        that changes committed out of order are not missed.
+
+        Parameters
+        ----------
+        cursor:
+            The psycopg2 cursor for interacting with the database.
+
+        Returns
+        -------
+        rows:
+            The number of rows updated or added.
+        """
+        delta, watermark = extract_changed_since(
+            cursor, self.table, self.watermark, conditions=self.conditions,
+            columns=self.columns, change_column=self.change_column)
+        if delta is None:
+            return 0
+        # The watermark can advance without any rows changing
+        self.watermark = watermark
+        if len(delta) == 0:
+            return 0
+
+        # A row changed more than once is reported once, with its latest
+        # values; keep the last (highest change sequence) copy of each key
+        keys = delta[self.key]
+        order = np.argsort(keys, kind="mergesort")
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = keys[order][1:] != keys[order][:-1]
+        delta = delta[order[last]]
+
+        if self.array is None:
+            self.array = delta
+            updated, added = 0, len(delta)
+        else:
+            if delta.dtype != self.array.dtype:
+                # e.g. longer text values, or a wider varchar after a schema
+                # change; widen both to hold either
+                dtype = np.dtype([
+                    (name, np.promote_types(self.array.dtype[name],
+                                            delta.dtype[name]))
+                    for name in self.array.dtype.names])
+                self.array = self.array.astype(dtype)
+                delta = delta.astype(dtype)
+            positions = np.searchsorted(self.array[self.key],
+                                        delta[self.key])
+            found = positions < len(self.array)
+            found[found] = (self.array[self.key][positions[found]] ==
+                            delta[self.key][found])
+            self.array[positions[found]] = delta[found]
+            new = delta[~found]
+            if len(new):
+                self.array = np.concatenate([self.array, new])
+                self.array = self.array[np.argsort(self.array[self.key],
+                                                   kind="mergesort")]
+            updated, added = int(found.sum()), len(new)
+
+        logging.info("Synced %s to change %d: %d rows updated, %d added" % (
+            self.table, watermark[0], updated, added))
+        return updated + added
+
+    def lookup(self, keys):
+        """
+        Get the rows for the given keys.
+
+        Parameters
+        ----------
+        keys:
+            Array-like of key values, all of which must be held.
+
+        Returns
+        -------
+        rows:
+            A numpy structured array of the matching rows, in the order of
+            keys.
+        """
+        keys = np.asarray(keys)
+        positions = np.searchsorted(self.array[self.key], keys)
+        if np.any(positions >= len(self.array)) or np.any(
+                self.array[self.key][np.minimum(
+                    positions, len(self.array) - 1)] != keys):
+            raise KeyError("Not all keys are in the catalog")
+        return self.array[positions]
+
+    def collection(self, factory):
+        """
+        Get the current rows as a TargetCollection. The collection is a
+        snapshot; take a new one after each sync.
+        """
+        return TargetCollection(self.array.copy(), factory)
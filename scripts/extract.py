@@ -1,7 +1,17 @@
+import collections
+import io
+import itertools
 import logging
+import math
 import numpy as np
 import re
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import weakref
+
+from instrument import measure
+from predicates import compile_conditions, And, Range, Sql
 
 
 # psql-numpy data type relationship
@@ -13,14 +23,52 @@ PSQL_TO_NUMPY_DTYPE = {
     "numeric": "float64",
     "real": "float32",
     "double": "float64",
+    "double precision": "float64",
     "smallserial": "int16",
     "serial": "int32",
     "bigserial": "int64",
     "boolean": "bool",
     "text": "str",
+    "timestamp": "datetime64[us]",
 }
 
 
+# PSQL data type for each of the PostgreSQL type OIDs that can be reported in
+# a cursor.description
+PSQL_OID_TO_TYPE = {
+    16: "boolean",
+    20: "bigint",
+    21: "smallint",
+    23: "integer",
+    25: "text",
+    700: "real",
+    701: "double precision",
+    1042: "char",
+    1043: "varchar",
+    1114: "timestamp",
+    1700: "numeric",
+}
+
+
+# psql-numpy data type relationship for the fixed-width types which can be
+# decoded directly from the PostgreSQL binary COPY format (big-endian)
+PSQL_TO_BINARY_DTYPE = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double": ">f8",
+    "double precision": ">f8",
+    "smallserial": ">i2",
+    "serial": ">i4",
+    "bigserial": ">i8",
+    "boolean": "?",
+}
+
+# Signature which opens every PostgreSQL binary COPY stream
+BINARY_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
 # Helper function - this should be called rather than the dict unless
 # you're SURE that you won't come across a char(n) or varchar(n)
 def psql_to_numpy_dtype(psql_dtype):
@@ -53,6 +101,408 @@ def psql_to_numpy_dtype(psql_dtype):
     return PSQL_TO_NUMPY_DTYPE[psql_dtype]
 
 
+# Counter used to give each server-side cursor a unique name
+_cursor_counter = itertools.count()
+
+# Per-connection cache of table structures, keyed by connection and then by
+# the tuple of (joined) table names. See invalidate_schema_cache.
+_schema_cache = weakref.WeakKeyDictionary()
+
+# Maximum number of prepared statements kept per connection
+PREPARED_CACHE_SIZE = 64
+
+# Counter used to give each prepared statement a unique name
+_prepared_counter = itertools.count()
+
+# Per-connection LRU of prepared statements, mapping statement text to the
+# name it was prepared under. See _execute.
+_prepared_cache = weakref.WeakKeyDictionary()
+_prepared_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Per-connection lists of the names of prepared statements which have been
+# dropped from _prepared_cache, but not yet DEALLOCATEd on the server
+_stale_prepared = weakref.WeakKeyDictionary()
+
+# Per-connection lists of the names of statements which were being prepared
+# or deallocated by a statement which failed, and so may or may not exist on
+# the server. See _verify_prepared.
+_unverified_prepared = weakref.WeakKeyDictionary()
+
+_PLACEHOLDER_REGEX = re.compile(r'%%|%s')
+
+
+def invalidate_schema_cache(connection=None):
+    """
+    Discard cached table structures.
+
+    This must be called whenever the database schema changes (e.g. by
+    scripts/update.update_database), so that stale column types are not
+    used for subsequent extracts.
+
+    Parameters
+    ----------
+    connection:
+        The psycopg2 connection whose cache should be cleared. Defaults to
+        None, which clears the cache for all connections.
+
+    Prepared statements are also discarded, as their result types may have
+    changed. They are DEALLOCATEd straight away if connection is given and
+    is not in a failed transaction; otherwise they are DEALLOCATEd before
+    the next statement executed on their connection by _execute (as the
+    connection may be in use by another thread).
+
+    Returns
+    -------
+    Nil. Cached structures are removed.
+    """
+    if connection is None:
+        _schema_cache.clear()
+        for conn in list(_prepared_cache.keys()):
+            _forget_prepared(conn)
+    else:
+        _schema_cache.pop(connection, None)
+        _forget_prepared(connection)
+        if not connection.closed and connection.get_transaction_status() in (
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE,
+                psycopg2.extensions.TRANSACTION_STATUS_INTRANS):
+            string = _deallocate_string(connection)
+            if string:
+                connection.cursor().execute(string)
+
+
+def _forget_prepared(connection, string=None):
+    """
+    Drop a statement (or, if string is None, all statements) from the
+    prepared statement cache of a connection, and queue the names for
+    DEALLOCATE.
+    """
+    cache = _prepared_cache.get(connection)
+    if not cache:
+        return
+    if string is None:
+        names = list(cache.values())
+        cache.clear()
+    else:
+        names = [cache.pop(string)] if string in cache else []
+    _stale_prepared.setdefault(connection, []).extend(names)
+
+
+def _deallocate_string(connection):
+    """
+    Take the names queued for DEALLOCATE on a connection, and return the
+    statement(s) deallocating them, or an empty string if there are none.
+    """
+    names = _stale_prepared.pop(connection, [])
+    return "".join("DEALLOCATE %s; " % name for name in names)
+
+
+def _verify_prepared(cursor):
+    """
+    Queue those of the unverified prepared statement names of the cursor's
+    connection which exist on the server for DEALLOCATE (as deallocating a
+    statement which does not exist is an error).
+    """
+    connection = cursor.connection
+    names = _unverified_prepared.get(connection)
+    if not names or connection.get_transaction_status() not in (
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE,
+            psycopg2.extensions.TRANSACTION_STATUS_INTRANS):
+        return
+    del _unverified_prepared[connection]
+    cursor.execute("SELECT name FROM pg_prepared_statements "
+                   "WHERE name = ANY(%s)", (names, ))
+    _stale_prepared.setdefault(connection, []).extend(
+        row[0] for row in cursor.fetchall())
+
+
+def prepared_statement_stats():
+    """
+    Get the prepared statement cache counters.
+
+    Returns
+    -------
+    stats:
+        Dictionary of the number of statement executions which reused a
+        prepared statement (hits), which had to prepare one (misses), and of
+        prepared statements deallocated to keep within PREPARED_CACHE_SIZE
+        (evictions), plus the number of statements currently prepared
+        (size), over all connections.
+    """
+    stats = dict(_prepared_stats)
+    stats["size"] = sum(len(c) for c in _prepared_cache.values())
+    return stats
+
+
+def reset_prepared_statement_stats():
+    """
+    Zero the prepared statement cache hit/miss/eviction counters.
+    """
+    for key in _prepared_stats:
+        _prepared_stats[key] = 0
+
+
+def _execute(cursor, string, params=None):
+    """
+    Execute a statement as a prepared statement.
+
+    The first time a statement is executed on a connection, it is PREPAREd
+    (in the same round trip); later executions of the same statement text,
+    with any parameter values, EXECUTE the prepared statement and so skip
+    parsing and planning. Each connection keeps its PREPARED_CACHE_SIZE most
+    recently used statements.
+
+    If the result type of a prepared statement has changed since it was
+    prepared (e.g. a table read with SELECT * has been altered by another
+    process), it is DEALLOCATEd and prepared again. If the statement was run
+    inside a transaction begun earlier, that transaction has been aborted by
+    the error, so the error is raised, and the statement is only prepared
+    again the next time it is executed. If the round trip preparing or
+    deallocating statements fails, the statements which were left prepared
+    are found (see _verify_prepared) and deallocated by the next one.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    string:
+        The statement, with %s placeholders for params.
+    params:
+        The sequence of values to bind to the placeholders, or None.
+
+    Returns
+    -------
+    Nil. The statement is executed on cursor.
+    """
+    if isinstance(params, dict) or PREPARED_CACHE_SIZE <= 0:
+        cursor.execute(string, params)
+        return
+
+    connection = cursor.connection
+    cache = _prepared_cache.setdefault(connection, collections.OrderedDict())
+    params = list(params) if params else None
+    # Statements dropped from the cache are deallocated in the same round
+    # trip as this one. If that fails, whether they were deallocated is not
+    # known.
+    _verify_prepared(cursor)
+    deallocating = list(_stale_prepared.get(connection, []))
+    deallocate_string = _deallocate_string(connection)
+
+    name = cache.pop(string, None)
+    if name is not None:
+        _prepared_stats["hits"] += 1
+        cache[string] = name
+        idle = connection.get_transaction_status() == \
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            cursor.execute(deallocate_string + _execute_string(name, params),
+                           params)
+        except psycopg2.Error as e:
+            if deallocating:
+                _unverified_prepared.setdefault(connection, []).extend(
+                    deallocating)
+            if e.pgcode != psycopg2.errorcodes.FEATURE_NOT_SUPPORTED:
+                raise
+            # "cached plan must not change result type"
+            logging.info("Result type of prepared statement %s has changed;"
+                         " preparing it again" % name)
+            _forget_prepared(connection, string)
+            if not idle:
+                raise
+            # The statement was the only one in its transaction, so
+            # nothing else is lost by rolling it back
+            if not connection.autocommit:
+                connection.rollback()
+            _execute(cursor, string, params)
+        return
+
+    _prepared_stats["misses"] += 1
+    name = "extract_prepared_%d" % next(_prepared_counter)
+    if params:
+        # Number the placeholders as PREPARE requires, leaving any escaped
+        # %% for psycopg2 to unescape
+        numbers = itertools.count(1)
+        prepare_string = _PLACEHOLDER_REGEX.sub(
+            lambda m: "%%" if m.group(0) == "%%" else "$%d" % next(numbers),
+            string)
+    else:
+        # Without parameters, psycopg2 does not interpolate the statement
+        prepare_string = string
+    try:
+        cursor.execute("%sPREPARE %s AS %s; %s" % (
+            deallocate_string, name, prepare_string,
+            _execute_string(name, params)), params)
+    except Exception:
+        # The statement may have been prepared before the EXECUTE failed,
+        # and prepared statements survive the rollback
+        _unverified_prepared.setdefault(connection, []).extend(
+            deallocating + [name])
+        raise
+    cache[string] = name
+
+    while len(cache) > PREPARED_CACHE_SIZE:
+        _, old_name = cache.popitem(last=False)
+        _stale_prepared.setdefault(connection, []).append(old_name)
+        _prepared_stats["evictions"] += 1
+
+
+def _execute_string(name, params):
+    """
+    Build the EXECUTE statement for a prepared statement, with a %s
+    placeholder for each of params.
+    """
+    if not params:
+        return "EXECUTE %s" % name
+    return "EXECUTE %s(%s)" % (name, ", ".join(["%s"] * len(params)))
+
+
+def _is_snapshot(cursor):
+    """
+    Check whether the cursor passed to an extract function is actually an
+    offline snapshot.Snapshot, which the extract is dispatched to instead.
+    """
+    return getattr(cursor, "is_snapshot", False) is True
+
+
+def _description_structure(description):
+    """
+    Derive column names and PSQL data types from a cursor.description, using
+    the type OID reported for each column.
+
+    Parameters
+    ----------
+    description:
+        The description attribute of a psycopg2 cursor which has executed a
+        query.
+
+    Returns
+    -------
+    columns, dtypes:
+        The column names, and the matching PSQL data types.
+    """
+    columns = []
+    dtypes = []
+    for column in description:
+        name, oid, internal_size = column[0], column[1], column[3]
+        if oid not in PSQL_OID_TO_TYPE:
+            raise ValueError("Column %s has unsupported PSQL type OID %d" % (
+                name, oid))
+        dtype = PSQL_OID_TO_TYPE[oid]
+        if dtype in ("char", "varchar"):
+            # psycopg2 never fills in the display size; the declared length
+            # of a char(n)/varchar(n) is reported as the internal size (from
+            # the type modifier). Unbounded varchar is treated as text.
+            if internal_size is not None and internal_size > 0:
+                dtype = "%s(%d)" % (dtype, internal_size)
+            else:
+                dtype = "text"
+        columns.append(name)
+        dtypes.append(dtype)
+    return columns, dtypes
+
+
+def _select_structure(columns, description):
+    """
+    Get the column names and PSQL data types of a query result. The names
+    given by the caller (if any) take precedence over those in description.
+    """
+    result_columns, dtypes = _description_structure(description)
+    if columns is None:
+        columns = result_columns
+    return columns, dtypes
+
+
+def _table_structure(cursor, tables, columns=None):
+    """
+    Look up the column names and PSQL data types of database table(s).
+
+    Table structures are cached per connection, so the database is only
+    queried the first time a given table (or join) is inspected.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    tables:
+        The name of the table to be inspected, or a list of table names to be
+        NATURAL JOINed. Columns that appear in more than one table (i.e. the
+        join columns) are only returned once.
+    columns:
+        Optional list of column names to restrict the result to. The returned
+        data types are in the same order as columns. Defaults to None, which
+        returns all table columns.
+
+    Returns
+    -------
+    columns, dtypes:
+        The column names, and the matching PSQL data types.
+    """
+    if isinstance(tables, str):
+        tables = [tables]
+    key = tuple(tables)
+    cache = _schema_cache.setdefault(cursor.connection, {})
+    if key not in cache:
+        string = "SELECT * FROM %s LIMIT 0" % (' NATURAL JOIN '.join(tables), )
+        with measure(cursor, string):
+            cursor.execute(string)
+        cache[key] = _description_structure(cursor.description)
+    table_columns, dtypes = cache[key]
+
+    if columns is None:
+        return list(table_columns), list(dtypes)
+
+    lookup = dict(zip([c.lower() for c in table_columns], dtypes))
+    try:
+        dtypes = [lookup[c.lower()] for c in columns]
+    except KeyError as e:
+        raise ValueError("Column %s not found in %s" % (
+            e.args[0], ", ".join(tables)))
+    return columns, dtypes
+
+
+def _numpy_dtype(columns, dtypes, rows=None):
+    """
+    Build the numpy structured dtype for the given columns and PSQL types.
+
+    Text columns have no declared length, so are given a unicode field as
+    wide as the longest of their values in rows (the fetched result rows),
+    and at least one character wide.
+    """
+    formats = []
+    for i, dtype in enumerate(dtypes):
+        numpy_dtype = psql_to_numpy_dtype(dtype)
+        if numpy_dtype == "str":
+            width = max([len(row[i]) for row in rows or []
+                         if row[i] is not None] or [1])
+            numpy_dtype = "U%d" % max(width, 1)
+        formats.append(numpy_dtype)
+    return {
+        "names": columns,
+        "formats": formats,
+        }
+
+
+def _select_string(table, columns=None, conditions=None):
+    """
+    Build the SELECT statement for reading columns from table (which may
+    be a join expression), subject to conditions.
+
+    Returns
+    -------
+    string, params:
+        The statement, with %s placeholders for the condition values, and
+        the values to bind to them (or None if there are none).
+    """
+    string = "SELECT %s FROM %s" % (
+        "*" if columns is None else ", ".join(columns),
+        table,
+        )
+
+    where_string, params = compile_conditions(conditions)
+    string += where_string
+
+    return string, params or None
+
+
 def extract_from(cursor, table, conditions=None, columns=None):
     """
     Extract rows from a database table.
@@ -64,9 +514,215 @@ def extract_from(cursor, table, conditions=None, columns=None):
     table:
         The name of the table to be read.
     conditions:
-        List of tuples denoting conditions to be supplied, in the form
-        [(column1, condition1), (column2, condition2), ...]
-        All conditions are assumed to be equalities. Defaults to None.
+        The conditions rows must satisfy: a predicate (see predicates.py),
+        or a list of predicates and/or (column, value) equality tuples, all
+        of which must hold. Values are bound as query parameters. Defaults
+        to None.
+    columns:
+        List of column names to retrieve from the database. Defaults to None,
+        which returns all available columns.
+
+    Returns
+    -------
+    result:
+        A numpy structured array of all table rows which satisfy conditions (if
+        given). Individual entry elements may be called by column name.
+    """
+
+    string, params = _select_string(table, columns, conditions)
+
+    logging.debug("%s with values %s" % (string, params))
+
+    if cursor is None:
+        result = None
+        return result
+    if _is_snapshot(cursor):
+        return cursor.extract(table, conditions, columns)
+
+    with measure(cursor, string, params) as m:
+        _execute(cursor, string, params)
+        result = cursor.fetchall()
+        logging.debug("Extract successful")
+
+        # Re-format the result as a structured numpy table, with the column
+        # types taken from the query result itself
+        with m.converting():
+            columns, dtypes = _select_structure(columns, cursor.description)
+            result = np.asarray(result, dtype=_numpy_dtype(columns, dtypes,
+                                                           result))
+        m.rows = len(result)
+        m.bytes = result.nbytes
+
+    return result
+
+
+def iter_extract_from(cursor, table, conditions=None, columns=None,
+                      chunk_size=10000):
+    """
+    Extract rows from a database table in chunks, using a server-side cursor.
+
+    Unlike extract_from, the full result set is never held in memory; rows
+    are transferred from the database chunk_size at a time.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database. The
+        server-side (named) cursor is opened on the same connection, and so
+        within the same transaction.
+    table:
+        The name of the table to be read, or a list of table names to be
+        joined using NATURAL JOIN (as per extract_from_joined).
+    conditions:
+        The conditions rows must satisfy: a predicate (see predicates.py),
+        or a list of predicates and/or (column, value) equality tuples, all
+        of which must hold. Values are bound as query parameters. Defaults
+        to None.
+    columns:
+        List of column names to retrieve from the database. Defaults to None,
+        which returns all available columns.
+    chunk_size:
+        Integer, denoting the number of rows to fetch (and yield) at a time.
+        Defaults to 10000.
+
+    Yields
+    ------
+    result:
+        A numpy structured array of up to chunk_size table rows which satisfy
+        conditions (if given). Individual entry elements may be called by
+        column name.
+    """
+
+    if isinstance(table, str):
+        tables = [table]
+    else:
+        tables = list(table)
+    from_string = ' NATURAL JOIN '.join(tables)
+
+    string, params = _select_string(from_string, columns, conditions)
+
+    logging.debug("%s with values %s" % (string, params))
+
+    if cursor is None:
+        return
+    if _is_snapshot(cursor):
+        result = cursor.extract(tables, conditions, columns)
+        for start in range(0, len(result), chunk_size):
+            yield result[start:start + chunk_size]
+        return
+
+    stream = cursor.connection.cursor(
+        name="iter_extract_%d" % (next(_cursor_counter), ))
+    stream.itersize = chunk_size
+    try:
+        stream.execute(string, params)
+        structure = None
+        while True:
+            # Each chunk is measured without a cursor, so that a slow chunk
+            # does not re-run the whole query under EXPLAIN
+            with measure(None, string, params) as m:
+                rows = stream.fetchmany(chunk_size)
+                if not rows:
+                    break
+                with m.converting():
+                    if structure is None:
+                        # A named cursor only has a description after the
+                        # first fetch
+                        structure = _select_structure(columns,
+                                                      stream.description)
+                    rows = np.asarray(rows, dtype=_numpy_dtype(
+                        structure[0], structure[1], rows))
+                m.rows = len(rows)
+                m.bytes = rows.nbytes
+            yield rows
+    finally:
+        stream.close()
+    logging.debug("Extract successful")
+
+
+def _decode_binary_copy(data, columns, dtypes):
+    """
+    Decode a PostgreSQL binary COPY stream into a numpy structured array.
+
+    The stream is viewed in place as an array of fixed-size tuple records
+    (a field count, then a length word and value for each field), so no
+    per-row Python objects are created.
+
+    Parameters
+    ----------
+    data:
+        The bytes of the binary COPY stream.
+    columns:
+        The names of the columns in the stream, in order.
+    dtypes:
+        The matching PSQL data types, all of which must be keys of
+        PSQL_TO_BINARY_DTYPE.
+
+    Returns
+    -------
+    result:
+        A numpy structured array, with the (native byte order) dtype given by
+        psql_to_numpy_dtype for each column.
+    """
+    if data[:len(BINARY_COPY_SIGNATURE)] != BINARY_COPY_SIGNATURE:
+        raise ValueError("Invalid binary COPY signature")
+    # Signature, then a 32-bit flags field and the header extension length
+    extension = np.frombuffer(data, dtype=">i4", count=1,
+                              offset=len(BINARY_COPY_SIGNATURE) + 4)[0]
+    offset = len(BINARY_COPY_SIGNATURE) + 8 + extension
+
+    wire_formats = [("_fields", ">i2")]
+    for i, (column, dtype) in enumerate(zip(columns, dtypes)):
+        wire_formats += [("_length%d" % i, ">i4"),
+                         (column, PSQL_TO_BINARY_DTYPE[dtype])]
+    wire_dtype = np.dtype(wire_formats)
+
+    # The stream ends with a 16-bit -1 trailer
+    body = len(data) - offset - 2
+    if data[-2:] != b"\xff\xff" or body % wire_dtype.itemsize != 0:
+        raise ValueError("Binary COPY stream does not consist of fixed-width"
+                         " rows - does the result contain NULLs?")
+    rows = np.frombuffer(data, dtype=wire_dtype,
+                         count=body // wire_dtype.itemsize, offset=offset)
+
+    if np.any(rows["_fields"] != len(columns)):
+        raise ValueError("Unexpected field count in binary COPY stream")
+    for i, column in enumerate(columns):
+        if np.any(rows["_length%d" % i] != wire_dtype[column].itemsize):
+            raise ValueError("Column %s contains NULL or variable-width"
+                             " values" % column)
+
+    result = np.empty(len(rows), dtype=_numpy_dtype(columns, dtypes))
+    for column in columns:
+        result[column] = rows[column]
+    return result
+
+
+def extract_from_binary(cursor, table, conditions=None, columns=None):
+    """
+    Extract rows from a database table using a binary COPY.
+
+    This is a fast counterpart of extract_from for large, numeric readouts
+    (e.g. positions and unit vectors). The query result is streamed with
+    COPY (SELECT ...) TO STDOUT WITH BINARY and decoded straight into a numpy
+    structured array, bypassing psycopg2's per-value conversion.
+
+    Only fixed-width column types (those in PSQL_TO_BINARY_DTYPE) without
+    NULL values are supported; numeric columns are cast to double precision
+    by the query. Use extract_from for anything else.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    table:
+        The name of the table to be read, or a list of table names to be
+        joined using NATURAL JOIN (as per extract_from_joined).
+    conditions:
+        The conditions rows must satisfy: a predicate (see predicates.py),
+        or a list of predicates and/or (column, value) equality tuples, all
+        of which must hold. Values are bound as query parameters. Defaults
+        to None.
     columns:
         List of column names to retrieve from the database. Defaults to None,
         which returns all available columns.
@@ -78,46 +734,122 @@ def extract_from(cursor, table, conditions=None, columns=None):
         given). Individual entry elements may be called by column name.
     """
 
-    if cursor is not None:
-        # Get the column names from the table itself
-        cursor.execute("SELECT column_name, data_type"
-            " FROM information_schema.columns"
-            " WHERE table_name='%s'" % (table, ))
-        table_structure = cursor.fetchall()
-        table_columns, dtypes = zip(*table_structure)
-        if columns is None:
-            columns = table_columns
+    if isinstance(table, str):
+        tables = [table]
+    else:
+        tables = list(table)
+    from_string = ' NATURAL JOIN '.join(tables)
+
+    if cursor is None:
+        logging.debug("%s with values %s" % _select_string(
+            from_string, columns, conditions))
+        return None
+    if _is_snapshot(cursor):
+        return cursor.extract(tables, conditions, columns)
+
+    columns, dtypes = _table_structure(cursor, tables, columns)
+    select_columns = []
+    for column, dtype in zip(columns, dtypes):
+        if dtype in ("decimal", "numeric"):
+            select_columns.append("%s::double precision AS %s" % (
+                column, column))
+        elif dtype in PSQL_TO_BINARY_DTYPE:
+            select_columns.append(column)
         else:
-            columns_lower = [x.lower() for x in columns]
-            dtypes = [dtypes[i] for i in range(len(dtypes))
-                      if table_columns[i].lower()
-                      in columns_lower]
+            raise ValueError("Column %s has type %s, which cannot be read with"
+                             " a binary extract" % (column, dtype))
+    dtypes = ["double precision" if dtype in ("decimal", "numeric")
+              else dtype for dtype in dtypes]
 
-    string = "SELECT %s FROM %s" % (
-        "*" if columns is None else "(" + ", ".join(columns) + ")",
-        table,
-        )
+    # COPY does not take bound parameters, so they are interpolated (with
+    # the usual quoting) on the client
+    select_string, params = _select_string(from_string, select_columns,
+                                           conditions)
+    select_string = cursor.mogrify(select_string, params)
+    if not isinstance(select_string, str):
+        select_string = select_string.decode("utf-8")
+    string = "COPY (%s) TO STDOUT WITH BINARY" % (select_string, )
+
+    logging.debug(string)
 
+    with measure(cursor, string) as m:
+        buf = io.BytesIO()
+        cursor.copy_expert(string, buf)
+        data = buf.getvalue()
+        with m.converting():
+            result = _decode_binary_copy(data, columns, dtypes)
+        m.rows = len(result)
+        m.bytes = len(data)
+    logging.debug("Extract successful")
+
+    return result
+
+
+def extract_cone(cursor, table, ra, dec, radius, conditions=None, columns=None):
+    """
+    Extract the rows of a table which lie within a cone on the sky.
+
+    The table must have ux, uy and uz unit vector columns. Rows are first
+    restricted to a box around the cone centre, of half-width equal to the
+    chord length of the cone radius, which can be answered from indexes on
+    those columns (declared in the table specs); the exact angular distance
+    is then only evaluated for the rows inside the box.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database.
+    table:
+        The name of the table to be read (e.g. 'target' or 'field').
+    ra, dec:
+        The position of the cone centre, in decimal degrees.
+    radius:
+        The cone radius, in decimal degrees.
+    conditions:
+        Additional conditions rows must satisfy, as for extract_from.
+        Defaults to None.
+    columns:
+        List of column names to retrieve from the database. Defaults to None,
+        which returns all available columns.
+
+    Returns
+    -------
+    result:
+        A numpy structured array of all table rows within the cone which
+        satisfy conditions (if given).
+    """
+
+    ra, dec, radius = math.radians(ra), math.radians(dec), math.radians(radius)
+    centre = (math.cos(dec) * math.cos(ra),
+              math.cos(dec) * math.sin(ra),
+              math.sin(dec))
+    chord = 2. * math.sin(radius / 2.)
+
+    cone = [Range(column, c - chord, c + chord)
+            for column, c in zip(["ux", "uy", "uz"], centre)]
+    cone.append(Sql("ux * %s + uy * %s + uz * %s >= %s",
+                    centre + (math.cos(radius), )))
     if conditions:
-        conditions_string = ' WHERE '.join([' = '.join(map(str, x))
-                                            for x in conditions])
-        string += conditions_string
+        cone.insert(0, conditions)
 
-    logging.debug(string)
+    string, params = _select_string(table, columns, And(*cone))
+
+    logging.debug("%s with values %s" % (string, params))
 
-    if cursor is not None:
-        cursor.execute(string)
+    if cursor is None:
+        return None
+
+    with measure(cursor, string, params) as m:
+        _execute(cursor, string, params)
         result = cursor.fetchall()
         logging.debug("Extract successful")
-    else:
-        result = None
-        return result
 
-    # Re-format the result as a structured numpy table
-    result = np.asarray(result, dtype={
-        "names": columns,
-        "formats": [psql_to_numpy_dtype(dtype) for dtype in dtypes],
-        })
+        with m.converting():
+            columns, dtypes = _select_structure(columns, cursor.description)
+            result = np.asarray(result, dtype=_numpy_dtype(columns, dtypes,
+                                                           result))
+        m.rows = len(result)
+        m.bytes = result.nbytes
 
     return result
 
@@ -136,9 +868,10 @@ def extract_from_joined(cursor, tables, conditions=None, columns=None):
         table. If this is not possible, some other solution will need to be
         implemented.
     conditions:
-        List of tuples denoting conditions to be supplied, in the form
-        [(column1, condition1), (column2, condition2), ...]
-        All conditions are assumed to be equalities. Defaults to None.
+        The conditions rows must satisfy: a predicate (see predicates.py),
+        or a list of predicates and/or (column, value) equality tuples, all
+        of which must hold. Values are bound as query parameters. Defaults
+        to None.
     columns:
         List of column names to retrieve from the database. Defaults to None,
         which returns all available columns.
@@ -151,61 +884,168 @@ def extract_from_joined(cursor, tables, conditions=None, columns=None):
         column name.
     """
 
-    if cursor is not None:
-        # Get the column names from the table itself
-        cursor.execute("SELECT column_name, data_type"
-            " FROM information_schema.columns"
-            " WHERE table_name LIKE '%s'" % ('|'.join(tables), ))
-        tables_structure = cursor.fetchall()
-        table_structure = cursor.fetchall()
-        table_columns, dtypes = zip(*table_structure)
-        if columns is None:
-            columns = table_columns
-        else:
-            columns_lower = [x.lower() for x in columns]
-            dtypes = [dtypes[i] for i in range(len(dtypes))
-                      if table_columns[i].lower()
-                      in columns_lower]
-    string = 'SELECT %s FROM %s' % (
-        "*" if columns is None else "(" + ", ".join(columns) + ")",
-        ' NATURAL JOIN '.join(tables),
-        )
+    string, params = _select_string(' NATURAL JOIN '.join(tables), columns,
+                                    conditions)
 
-    if conditions:
-        conditions_string = ' WHERE '.join([' = '.join(map(str, x))
-                                            for x in conditions])
-        string += conditions_string
+    logging.debug("%s with values %s" % (string, params))
 
-    logging.debug(string)
+    if cursor is None:
+        result = None
+        return result
+    if _is_snapshot(cursor):
+        return cursor.extract(tables, conditions, columns)
 
-    if cursor is not None:
-        cursor.execute(string)
+    with measure(cursor, string, params) as m:
+        _execute(cursor, string, params)
         result = cursor.fetchall()
         logging.debug("Extract successful")
-    else:
-        result = None
-        return result
 
-    # Re-format the result as a structured numpy table
-    result = np.asarray(result, dtype={
-        "names": columns,
-        "formats": [psql_to_numpy_dtype(dtype) for dtype in dtypes],
-        })
+        # Re-format the result as a structured numpy table, with the column
+        # types taken from the query result itself
+        with m.converting():
+            columns, dtypes = _select_structure(columns, cursor.description)
+            result = np.asarray(result, dtype=_numpy_dtype(columns, dtypes,
+                                                           result))
+        m.rows = len(result)
+        m.bytes = result.nbytes
 
     return result
 
 
-def execute_select(connection, statement):
+def _change_horizon(cursor, change_sequence):
+    """
+    Read the last value drawn from a change sequence, then the transaction
+    id horizons of a new snapshot.
+
+    As the writers of tracked tables are given a transaction id before they
+    draw a change sequence value (see create.CHANGE_NEXT_FUNCTION), every
+    transaction holding a value up to last_value has a transaction id below
+    xmax; once a snapshot's xmin reaches xmax, all of those transactions
+    have finished.
+
+    Returns
+    -------
+    last_value, xmin, xmax:
+        The last sequence value, and the xmin and xmax of the snapshot.
+    """
+    # Separate statements, so that the snapshot is taken after the
+    # sequence is read
+    cursor.execute("SELECT last_value FROM %s" % change_sequence)
+    last_value = cursor.fetchone()[0]
+    cursor.execute("SELECT txid_snapshot_xmin(s), txid_snapshot_xmax(s) "
+                   "FROM txid_current_snapshot() s")
+    xmin, xmax = cursor.fetchone()
+    return last_value, xmin, xmax
+
+
+def extract_changed_since(cursor, table, since, conditions=None, columns=None,
+                          change_column="change_seq",
+                          change_sequence="change_seq"):
+    """
+    Extract the rows of a change-tracked table (see the @track_changes
+    table spec directive) which have been inserted or changed since a given
+    watermark.
+
+    Deleted rows are not reported. Transactions writing the tracked tables
+    concurrently may commit in a different order from the one in which they
+    drew their change sequence values, so a later commit can carry lower
+    values than rows already read. The returned watermark therefore only
+    moves past a sequence value once every transaction which could hold it
+    has finished; until then, the rows changed since are read again by each
+    call (so some rows may be returned more than once). This relies on each
+    call taking a new snapshot, i.e. on the cursor's transactions being READ
+    COMMITTED (the default).
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor that interacts with the relevant database (or
+        an offline snapshot.Snapshot).
+    table:
+        The name of the tracked table, or a list of table names to be
+        NATURAL JOINed (exactly one of which is tracked).
+    since:
+        The watermark returned by the previous call. Pass 0 to read all
+        rows.
+    conditions:
+        Additional conditions rows must satisfy, as for extract_from.
+        Defaults to None.
+    columns:
+        List of column names to retrieve from the database. The change
+        column is always included. Defaults to None, which returns all
+        available columns.
+    change_column:
+        The name of the change sequence column. Defaults to "change_seq".
+    change_sequence:
+        The name of the sequence the change column is drawn from. Defaults
+        to "change_seq".
+
+    Returns
+    -------
+    result:
+        A numpy structured array of the changed rows, ordered by their
+        change sequence.
+    watermark:
+        The watermark to pass as since to read the next set of changes: a
+        tuple of the sequence value up to which all changes have been read,
+        and the (sequence value, transaction id) horizons still waiting for
+        their transactions to finish.
+    """
+    if isinstance(since, tuple):
+        seq, horizons = since
+    else:
+        seq, horizons = int(since), ()
+
+    changed = Range(change_column, low=seq + 1)
+    if conditions:
+        changed = And(conditions, changed)
+    if columns is not None and change_column not in columns:
+        columns = list(columns) + [change_column]
+
+    horizon = None
+    if cursor is not None and not _is_snapshot(cursor):
+        horizon = _change_horizon(cursor, change_sequence)
+
+    if isinstance(table, str):
+        result = extract_from(cursor, table, changed, columns)
+    else:
+        result = extract_from_joined(cursor, table, changed, columns)
+    if result is None:
+        return None, since
+
+    result = result[np.argsort(result[change_column], kind="mergesort")]
+    if horizon is None:
+        # An offline snapshot has no transactions in flight
+        if len(result):
+            seq = max(seq, int(result[change_column][-1]))
+    else:
+        last_value, xmin, xmax = horizon
+        horizons = list(horizons) + [(last_value, xmax)]
+        # Every transaction below xmin had finished before the rows were
+        # read, so all of the values up to the horizons they cover were read
+        seq = max([seq] + [value for value, x in horizons if x <= xmin])
+        horizons = tuple((value, x) for value, x in horizons
+                         if value > seq and x > xmin)
+    logging.debug("Extracted %d rows of %s changed since %d" % (
+        len(result), table, seq))
+    return result, (seq, horizons)
+
+
+def execute_select(connection, statement, params=None):
     """ Execute an arbitrary SELECT statement.
 
-    Uses a new cursor.
+    Uses a new cursor. The statement is prepared on first use, and the
+    prepared statement reused on later calls (see _execute).
 
     Parameters
     ----------
     connection : psycopg2 connection
         The database connection with which to generate a cursor from
     statement : str
-        The SELECT statement query to execute
+        The SELECT statement query to execute, with %s placeholders for
+        params
+    params : sequence, optional
+        The values to bind to the placeholders in statement
 
     Returns
     -------
@@ -216,11 +1056,13 @@ def execute_select(connection, statement):
     assert statement.upper().find("SELECT") == 0, "You must submit a SELECT statement, that begins with SELECT"
     try:
         logging.info("Executing statement: %s" % statement)
-        cursor.execute(statement)
+        with measure(cursor, statement, params) as m:
+            _execute(cursor, statement, params)
+            result = cursor.fetchall()
+            m.rows = len(result)
     except psycopg2.ProgrammingError as e:
         logging.error(e)
         return []
-    result = cursor.fetchall()
     logging.info("Found %d rows" % len(result))
     return result
 
@@ -0,0 +1,205 @@
+from astropy.io import fits
+import logging
+import numpy as np
+
+
+# Default number of catalogue rows read, converted and loaded in each pass
+DEFAULT_CHUNK_SIZE = 100000
+
+# Column names (in order) written to the target table by target_columns
+TARGET_COLUMNS = ["TARGET_ID", "RA", "DEC", "IS_SCIENCE", "IS_STANDARD",
+                  "IS_GUIDE", "UX", "UY", "UZ"]
+
+
+def polar2cart_columns(ra, dec):
+    """
+    Convert columns of RA and Dec to unit-sphere Cartesian coordinates.
+
+    This is the vectorized equivalent of taipan.core.polar2cart, operating on
+    whole arrays rather than a single (ra, dec) tuple.
+
+    Parameters
+    ----------
+    ra, dec:
+        Array-likes of right ascension and declination, in decimal degrees.
+
+    Returns
+    -------
+    ux, uy, uz:
+        Arrays of the x, y and z projections on the unit sphere.
+    """
+    ra = np.radians(np.asarray(ra, dtype="float64"))
+    dec = np.radians(np.asarray(dec, dtype="float64"))
+    cos_dec = np.cos(dec)
+    return cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)
+
+
+def flag_column(value, length):
+    """
+    Build a boolean column with the same value in every row.
+
+    Parameters
+    ----------
+    value:
+        The boolean value to fill the column with.
+    length:
+        The number of rows in the column.
+
+    Returns
+    -------
+    column:
+        A numpy boolean array of the requested length.
+    """
+    return np.full(length, bool(value), dtype=bool)
+
+
+def target_columns(target_id, ra, dec, is_science=False, is_standard=False,
+                   is_guide=False):
+    """
+    Build the column arrays for writing a catalogue to the target table.
+
+    Parameters
+    ----------
+    target_id, ra, dec:
+        Array-likes of the target ids and positions (in decimal degrees).
+    is_science, is_standard, is_guide:
+        Booleans, denoting the type of target being written. Each is applied
+        to every row. Default to False.
+
+    Returns
+    -------
+    columns:
+        The list of target table column names, TARGET_COLUMNS.
+    arrays:
+        The list of column arrays, in the order of columns.
+    """
+    target_id = np.asarray(target_id)
+    ra = np.asarray(ra, dtype="float64")
+    dec = np.asarray(dec, dtype="float64")
+    ux, uy, uz = polar2cart_columns(ra, dec)
+    length = len(target_id)
+    arrays = [target_id, ra, dec,
+              flag_column(is_science, length),
+              flag_column(is_standard, length),
+              flag_column(is_guide, length),
+              ux, uy, uz]
+    return TARGET_COLUMNS, arrays
+
+
+def iter_fits_chunks(filename, columns, chunk_size=DEFAULT_CHUNK_SIZE, hdu=1,
+                     start_row=0):
+    """
+    Read columns from a FITS binary table in fixed-size row chunks.
+
+    The file is memory-mapped, and only the requested columns of the current
+    chunk are copied into memory, so peak memory use is bounded by
+    chunk_size rather than by the size of the file.
+
+    Parameters
+    ----------
+    filename:
+        The path to the FITS file to be read.
+    columns:
+        List of the names of the columns to read.
+    chunk_size:
+        Integer, denoting the number of rows to read in each chunk. Defaults
+        to DEFAULT_CHUNK_SIZE.
+    hdu:
+        The index of the binary table HDU within the file. Defaults to 1.
+    start_row:
+        Integer, denoting the first row to read, e.g. to resume from a
+        checkpoint (see get_checkpoint). Defaults to 0.
+
+    Yields
+    ------
+    chunk:
+        A dictionary mapping each of columns to a numpy array holding that
+        column's values for the current chunk of rows.
+    """
+    hdulist = fits.open(filename, memmap=True)
+    try:
+        data = hdulist[hdu].data
+        nrows = 0 if data is None else len(data)
+        logging.debug("Streaming %d rows from %s in chunks of %d" % (
+            nrows, filename, chunk_size))
+        for start in range(start_row, nrows, chunk_size):
+            rows = data[start:start + chunk_size]
+            yield dict((c, np.array(rows.field(c))) for c in columns)
+        del data
+    finally:
+        hdulist.close()
+
+
+# Table recording the progress of resumable catalogue loads
+PROGRESS_TABLE = "ingest_progress"
+
+
+def get_checkpoint(cursor, source):
+    """
+    Get the progress of a resumable catalogue load.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database. If None,
+        there is no progress.
+    source:
+        The name of the source being loaded (typically the catalogue file).
+
+    Returns
+    -------
+    chunks, row_count:
+        The number of chunks, and of rows, of source committed so far.
+    """
+    if cursor is None:
+        return 0, 0
+    cursor.execute("SELECT chunks, row_count FROM %s WHERE source = %%s" %
+                   PROGRESS_TABLE, (source, ))
+    result = cursor.fetchall()
+    if not result:
+        return 0, 0
+    return result[0]
+
+
+def checkpoint(cursor, source, chunks, row_count):
+    """
+    Record the progress of a resumable catalogue load, and commit it
+    together with the data loaded since the previous checkpoint.
+
+    This commits the cursor's connection, and so cannot be used within the
+    single transaction of a non-resumable upgrade.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database. If None,
+        nothing is done.
+    source:
+        The name of the source being loaded (typically the catalogue file).
+    chunks, row_count:
+        The total number of chunks, and of rows, of source loaded so far.
+
+    Returns
+    -------
+    Nil. The progress is committed to the database.
+    """
+    if cursor is None:
+        return
+    cursor.execute("INSERT INTO %s (source, chunks, row_count) "
+                   "VALUES (%%s, %%s, %%s) ON CONFLICT (source) DO UPDATE "
+                   "SET chunks = EXCLUDED.chunks, "
+                   "row_count = EXCLUDED.row_count, "
+                   "updated = CURRENT_TIMESTAMP" % PROGRESS_TABLE,
+                   (source, chunks, row_count))
+    cursor.connection.commit()
+    logging.info("Checkpoint: %d rows (%d chunks) of %s committed" % (
+        row_count, chunks, source))
+
+
+def clear_checkpoints(cursor):
+    """
+    Remove all load progress records, once an upgrade has completed.
+    """
+    if cursor is None:
+        return
+    cursor.execute("DELETE FROM %s" % PROGRESS_TABLE)
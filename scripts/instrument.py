@@ -0,0 +1,316 @@
+import atexit
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+
+# Upper edges (seconds) of the statement latency histogram buckets
+LATENCY_BUCKETS = [1e-4, 1e-3, 1e-2, 1e-1, 1., 10., 100., float("inf")]
+
+# Maximum number of EXPLAIN outputs kept for each query shape
+MAX_EXPLAINS = 3
+
+# Setting this environment variable to a file path enables instrumentation
+# at import time, and appends the statistics to that file at process exit
+PROFILE_ENV = "TAIPANDB_PROFILE"
+# Optional EXPLAIN latency threshold (seconds) to use with PROFILE_ENV
+EXPLAIN_ENV = "TAIPANDB_PROFILE_EXPLAIN"
+
+_enabled = False
+_explain_threshold = None
+_stats = {}
+_lock = threading.Lock()
+
+_STRING_REGEX = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_REGEX = re.compile(r"(?<![\w$])-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?")
+_LIST_REGEX = re.compile(r"\((?:\s*(?:\?|%s)\s*,)+\s*(?:\?|%s)\s*\)")
+_SPACE_REGEX = re.compile(r"\s+")
+
+
+def query_shape(statement):
+    """
+    Reduce a SQL statement to its shape, by replacing literal values (and
+    lists of them) with placeholders, so that statements which only differ
+    in their values are aggregated together.
+
+    Parameters
+    ----------
+    statement:
+        The SQL statement.
+
+    Returns
+    -------
+    shape:
+        The normalised statement.
+    """
+    shape = _STRING_REGEX.sub("?", statement)
+    shape = _NUMBER_REGEX.sub("?", shape)
+    shape = _LIST_REGEX.sub("(...)", shape)
+    return _SPACE_REGEX.sub(" ", shape).strip()
+
+
+def enable(explain_threshold=None, dump_file=None):
+    """
+    Turn on statement instrumentation.
+
+    Parameters
+    ----------
+    explain_threshold:
+        Latency (seconds) above which SELECT statements are re-run with
+        EXPLAIN (ANALYZE, BUFFERS), and the plan kept with the statistics.
+        Note that this executes the statement a second time, on the same
+        connection (inside a savepoint, which is rolled back). Statements
+        measured without a cursor, such as the chunks of a streamed fetch,
+        are never re-run. Defaults to None, which never runs EXPLAIN.
+    dump_file:
+        Path of a file to append the statistics to (see dump) when the
+        process exits. Defaults to None, which does not dump at exit.
+    """
+    global _enabled, _explain_threshold
+    _enabled = True
+    _explain_threshold = explain_threshold
+    if dump_file is not None:
+        atexit.register(_dump_at_exit, dump_file)
+
+
+def disable():
+    """
+    Turn off statement instrumentation. Collected statistics are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Discard all collected statistics.
+    """
+    with _lock:
+        _stats.clear()
+
+
+class _ShapeStats(object):
+    """Aggregate statistics for one query shape"""
+
+    def __init__(self):
+        self.count = 0
+        self.latency = 0.
+        self.max_latency = 0.
+        self.rows = 0
+        self.bytes = 0
+        self.convert_time = 0.
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.explains = []
+
+    def add(self, latency, rows, nbytes, convert_time):
+        self.count += 1
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.rows += rows
+        self.bytes += nbytes
+        self.convert_time += convert_time
+        for i, edge in enumerate(LATENCY_BUCKETS):
+            if latency <= edge:
+                self.histogram[i] += 1
+                break
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_latency_s": self.latency,
+            "mean_latency_s": self.latency / self.count if self.count else 0.,
+            "max_latency_s": self.max_latency,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "convert_time_s": self.convert_time,
+            "latency_histogram": dict(zip(
+                ["<=%g" % edge for edge in LATENCY_BUCKETS], self.histogram)),
+            "explains": list(self.explains),
+        }
+
+
+def get_stats():
+    """
+    Get the statistics collected so far.
+
+    Returns
+    -------
+    stats:
+        Dictionary mapping each query shape to a dictionary of its
+        aggregate statistics: statement count, total/mean/max latency, rows
+        and bytes transferred, time spent converting results to numpy, a
+        latency histogram (keyed by bucket upper edge) and any EXPLAIN
+        outputs.
+    """
+    with _lock:
+        return dict((shape, stats.as_dict())
+                    for shape, stats in _stats.items())
+
+
+def dump(stream=None):
+    """
+    Write the collected statistics as a single line of JSON.
+
+    Parameters
+    ----------
+    stream:
+        File-like object to write to. Defaults to None, which writes to
+        sys.stderr.
+    """
+    if stream is None:
+        stream = sys.stderr
+    stream.write(json.dumps({"pid": os.getpid(), "module": __name__,
+                             "time": time.time(), "queries": get_stats()}))
+    stream.write("\n")
+
+
+class _Measurement(object):
+    """
+    Context manager timing one statement. Callers set the rows and bytes
+    attributes, and wrap numpy conversion in converting().
+    """
+
+    def __init__(self, cursor, statement, params):
+        self.cursor = cursor
+        self.statement = statement
+        self.params = params
+        self.rows = 0
+        self.bytes = 0
+        self.convert_time = 0.
+        self.start = None
+
+    def __enter__(self):
+        if _enabled:
+            self.start = time.time()
+        return self
+
+    def converting(self):
+        return _Converting(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is None or exc_type is not None:
+            return False
+        latency = time.time() - self.start - self.convert_time
+        shape = query_shape(self.statement)
+        with _lock:
+            stats = _stats.setdefault(shape, _ShapeStats())
+            stats.add(latency, self.rows, self.bytes, self.convert_time)
+            explain = (_explain_threshold is not None
+                       and latency >= _explain_threshold
+                       and len(stats.explains) < MAX_EXPLAINS)
+        if explain and self.cursor is not None and \
+                self.statement.lstrip().upper().startswith("SELECT"):
+            self._explain(shape, latency)
+        return False
+
+    def _explain(self, shape, latency):
+        # The statement is re-run on the caller's connection, so it must not
+        # change the state of the caller's transaction, even if it fails: in
+        # a transaction, it is run inside a savepoint which is rolled back
+        # afterwards, and outside one, the transaction it opens is rolled
+        # back. It is skipped if the caller's transaction has already failed.
+        import psycopg2.extensions
+        connection = self.cursor.connection
+        status = connection.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            savepoint = "taipandb_explain"
+        elif status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            savepoint = None
+        else:
+            return
+        cursor = connection.cursor()
+        try:
+            if savepoint is not None:
+                cursor.execute("SAVEPOINT %s" % savepoint)
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + self.statement,
+                               self.params)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            finally:
+                if savepoint is not None:
+                    cursor.execute("ROLLBACK TO SAVEPOINT %s" % savepoint)
+                    cursor.execute("RELEASE SAVEPOINT %s" % savepoint)
+                elif not connection.autocommit:
+                    connection.rollback()
+        except Exception as e:
+            logging.warning("Could not EXPLAIN slow statement %s: %s" % (
+                self.statement, e))
+            return
+        finally:
+            cursor.close()
+        logging.info("Slow statement (%.3f s): %s\n%s" % (
+            latency, self.statement, plan))
+        with _lock:
+            _stats[shape].explains.append({"latency_s": latency,
+                                           "plan": plan})
+
+
+class _Converting(object):
+    """Context manager accumulating numpy conversion time"""
+
+    def __init__(self, measurement):
+        self.measurement = measurement
+        self.start = None
+
+    def __enter__(self):
+        if self.measurement.start is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            self.measurement.convert_time += time.time() - self.start
+        return False
+
+
+def measure(cursor, statement, params=None):
+    """
+    Instrument a statement.
+
+    Usage:
+
+        with measure(cursor, string) as m:
+            cursor.execute(string)
+            result = cursor.fetchall()
+            with m.converting():
+                result = np.asarray(result, ...)
+            m.rows = len(result)
+            m.bytes = result.nbytes
+
+    When instrumentation is disabled, this does nothing.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor executing the statement. May be None, in which
+        case the statement is never re-run under EXPLAIN.
+    statement:
+        The SQL statement, used to determine the query shape.
+    params:
+        The statement parameters, if any; only used to run EXPLAIN.
+
+    Returns
+    -------
+    measurement:
+        A context manager recording the statement on exit.
+    """
+    return _Measurement(cursor, statement, params)
+
+
+def _dump_at_exit(path):
+    with open(path, "a") as stream:
+        dump(stream)
+
+
+if os.environ.get(PROFILE_ENV):
+    enable(explain_threshold=float(os.environ[EXPLAIN_ENV])
+           if os.environ.get(EXPLAIN_ENV) else None,
+           dump_file=os.environ[PROFILE_ENV])
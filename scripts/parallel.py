@@ -0,0 +1,251 @@
+import imp
+import logging
+import multiprocessing
+import os
+import time
+
+from connection import get_connection
+from create import CHANGE_COLUMN
+
+
+def _load_catalog(job):
+    """
+    Run a single catalogue loader on its own connection, writing into the
+    job's staging schema.
+
+    This function is executed in a worker process.
+
+    Parameters
+    ----------
+    job:
+        Tuple of (loader_file, kwargs, schema): the path of the loader module,
+        the keyword arguments to pass to its execute function, and the name
+        of the staging schema to load into.
+
+    Returns
+    -------
+    schema:
+        The name of the staging schema.
+    """
+    loader_file, kwargs, schema = job
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        # The loader's (unqualified) table names resolve to the staging
+        # copies of the tables
+        cursor.execute("SELECT current_setting('search_path')")
+        cursor.execute("SET search_path TO %s, %s" % (
+            schema, cursor.fetchone()[0]))
+        loader = imp.load_source(
+            os.path.splitext(os.path.basename(loader_file))[0], loader_file)
+        start = time.time()
+        loader.execute(cursor, **kwargs)
+        connection.commit()
+        logging.info("Staged %s in %.2f s" % (
+            os.path.basename(loader_file), time.time() - start))
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return schema
+
+
+def _staged_tables(cursor):
+    """
+    List the tables of the current schema (but not the individual partitions
+    of partitioned tables), ordered so that tables come after the tables
+    their foreign keys reference.
+    """
+    cursor.execute("SELECT c.relname FROM pg_class c "
+                   "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE n.nspname = current_schema() "
+                   "AND c.relkind IN ('r', 'p') "
+                   "AND NOT c.relispartition ORDER BY c.relname")
+    tables = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT c.relname, r.relname FROM pg_constraint k "
+                   "JOIN pg_class c ON c.oid = k.conrelid "
+                   "JOIN pg_class r ON r.oid = k.confrelid "
+                   "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE k.contype = 'f' "
+                   "AND n.nspname = current_schema()")
+    references = {}
+    for table, referenced in cursor.fetchall():
+        if table != referenced:
+            references.setdefault(table, set()).add(referenced)
+
+    ordered = []
+    while tables:
+        ready = [t for t in tables
+                 if not references.get(t, set()) & set(tables)]
+        if not ready:
+            raise ValueError("Circular foreign keys between tables %s" %
+                             (tables, ))
+        ordered += ready
+        tables = [t for t in tables if t not in ready]
+    return ordered
+
+
+def create_staging(cursor, schema, tables):
+    """
+    Create a staging schema holding an empty copy (with the same columns and
+    defaults, but no constraints, indexes or triggers) of each table.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database.
+    schema:
+        The name of the staging schema.
+    tables:
+        List of table names.
+
+    Returns
+    -------
+    Nil. The staging schema and tables are created.
+    """
+    cursor.execute("CREATE SCHEMA %s" % schema)
+    for table in tables:
+        cursor.execute("CREATE TABLE %s.%s (LIKE %s INCLUDING DEFAULTS)" % (
+            schema, table, table))
+
+
+def merge_staging(cursor, schemas):
+    """
+    Copy the rows loaded into staging schemas into the real tables.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database.
+    schemas:
+        The names of the staging schemas, as returned by run_parallel_ingest.
+
+    Returns
+    -------
+    rows:
+        The total number of rows copied.
+    """
+    if not schemas:
+        return 0
+    start = time.time()
+    rows = 0
+    for table in _staged_tables(cursor):
+        # Change sequence values drawn by the loaders' (finished)
+        # transactions are left behind, so that the column default draws
+        # new ones in this transaction, which makes the rows visible (see
+        # extract.extract_changed_since)
+        cursor.execute("SELECT attname FROM pg_attribute "
+                       "WHERE attrelid = %s::regclass AND attnum > 0 "
+                       "AND NOT attisdropped AND attname <> %s "
+                       "ORDER BY attnum", (table, CHANGE_COLUMN))
+        columns = ", ".join(row[0] for row in cursor.fetchall())
+        for schema in schemas:
+            # Skip empty copies
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM %s.%s)" % (
+                schema, table))
+            if not cursor.fetchone()[0]:
+                continue
+            cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s.%s" % (
+                table, columns, columns, schema, table))
+            rows += cursor.rowcount
+    logging.info("Merged %d staged rows in %.2f s" % (
+        rows, time.time() - start))
+    return rows
+
+
+def drop_staging(cursor, schemas):
+    """
+    Drop staging schemas, and the tables in them.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database.
+    schemas:
+        The names of the staging schemas, as returned by run_parallel_ingest.
+        Schemas which do not exist are ignored.
+
+    Returns
+    -------
+    Nil. The staging schemas are dropped.
+    """
+    for schema in schemas:
+        cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+        logging.debug("Dropped staging schema %s" % schema)
+
+
+def run_parallel_ingest(connection, jobs, processes=None):
+    """
+    Run independent catalogue loaders in parallel.
+
+    Each loader is run in its own worker process, reading, converting and
+    writing its catalogue over its own database connection. The loaders
+    write into a staging schema per job, holding empty copies of the tables
+    of the current schema, and commit there; the real tables are not
+    touched. The caller then moves the staged rows into the real tables with
+    merge_staging (so that they are committed in the caller's transaction,
+    along with anything done with them), and removes the staging schemas
+    with drop_staging.
+
+    As each loader writes to its own copies of the tables, loaders never
+    wait on each other's rows; rows loaded by more than one loader (e.g. a
+    target_id in two catalogues) violate the primary key in merge_staging.
+
+    Parameters
+    ----------
+    connection:
+        The coordinating psycopg2 connection. The staging schemas are
+        created and committed over it, so it must not be in a transaction
+        with changes which should not yet be committed.
+    jobs:
+        List of (loader_file, kwargs) tuples: the path of each loader module,
+        and the keyword arguments to pass to its execute function (after the
+        cursor).
+    processes:
+        Integer, denoting the number of worker processes to use. Defaults to
+        None, which uses one process per job.
+
+    Returns
+    -------
+    schemas:
+        The names of the staging schemas, one per job.
+    """
+    if not jobs:
+        return []
+
+    prefix = "taipandb_staging_%d_%d" % (os.getpid(), int(time.time()))
+    tasks = [(loader_file, kwargs, "%s_%d" % (prefix, i))
+             for i, (loader_file, kwargs) in enumerate(jobs)]
+    schemas = [schema for _, _, schema in tasks]
+
+    cursor = connection.cursor()
+    tables = _staged_tables(cursor)
+    try:
+        for schema in schemas:
+            create_staging(cursor, schema, tables)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    logging.info("Running %d catalogue loaders in parallel" % len(tasks))
+
+    pool = multiprocessing.Pool(processes or len(tasks))
+    results = [pool.apply_async(_load_catalog, (task, )) for task in tasks]
+    pool.close()
+
+    errors = []
+    for task, result in zip(tasks, results):
+        try:
+            result.get()
+        except Exception as e:
+            logging.error("Loader %s failed: %s" % (task[0], e))
+            errors.append(e)
+    pool.join()
+
+    if errors:
+        drop_staging(cursor, schemas)
+        connection.commit()
+        raise errors[0]
+
+    return schemas
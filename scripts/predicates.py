@@ -0,0 +1,223 @@
+import numpy as np
+
+
+class Predicate(object):
+    """
+    Base class of the WHERE clause predicates accepted as extract conditions.
+
+    Predicates compile to SQL with %s placeholders and a list of the values
+    to bind to them, so values are never pasted into the statement text.
+    They may be combined with & (AND), | (OR) and ~ (NOT).
+    """
+
+    def compile(self):
+        """
+        Compile the predicate.
+
+        Returns
+        -------
+        string, params:
+            The SQL fragment, with %s placeholders, and the list of values to
+            bind to them.
+        """
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+def _value(value):
+    """Convert numpy scalars to the Python values psycopg2 can bind"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class Eq(Predicate):
+    """column = value"""
+
+    def __init__(self, column, value):
+        self.column = column
+        self.value = _value(value)
+
+    def compile(self):
+        return "%s = %%s" % self.column, [self.value]
+
+    def __repr__(self):
+        return "Eq(%r, %r)" % (self.column, self.value)
+
+
+class Range(Predicate):
+    """
+    low <= column <= high. Either bound may be None, in which case the range
+    is open on that side.
+    """
+
+    def __init__(self, column, low=None, high=None):
+        if low is None and high is None:
+            raise ValueError("Range on %s needs at least one bound" % column)
+        self.column = column
+        self.low = _value(low)
+        self.high = _value(high)
+
+    def compile(self):
+        if self.high is None:
+            return "%s >= %%s" % self.column, [self.low]
+        if self.low is None:
+            return "%s <= %%s" % self.column, [self.high]
+        return "%s BETWEEN %%s AND %%s" % self.column, [self.low, self.high]
+
+    def __repr__(self):
+        return "Range(%r, %r, %r)" % (self.column, self.low, self.high)
+
+
+class In(Predicate):
+    """
+    column is one of values. The values are bound as a single array
+    parameter (column = ANY(%s)), so the statement text does not depend on
+    the number of values.
+    """
+
+    def __init__(self, column, values):
+        self.column = column
+        if isinstance(values, np.ndarray):
+            self.values = values.tolist()
+        else:
+            self.values = [_value(v) for v in values]
+
+    def compile(self):
+        return "%s = ANY(%%s)" % self.column, [self.values]
+
+    def __repr__(self):
+        return "In(%r, %r)" % (self.column, self.values)
+
+
+class IsNull(Predicate):
+    """column IS NULL, or column IS NOT NULL if null is False"""
+
+    def __init__(self, column, null=True):
+        self.column = column
+        self.null = bool(null)
+
+    def compile(self):
+        return "%s IS %sNULL" % (self.column, "" if self.null else "NOT "), []
+
+    def __repr__(self):
+        return "IsNull(%r, %r)" % (self.column, self.null)
+
+
+class Sql(Predicate):
+    """
+    A literal SQL fragment with %s placeholders and the values to bind to
+    them, for conditions not covered by the other predicates.
+    """
+
+    def __init__(self, string, params=None):
+        self.string = string
+        self.params = [_value(p) for p in params or []]
+
+    def compile(self):
+        return self.string, list(self.params)
+
+    def __repr__(self):
+        return "Sql(%r, %r)" % (self.string, self.params)
+
+
+class _Combination(Predicate):
+    operator = None
+
+    def __init__(self, *predicates):
+        self.predicates = [as_predicate(p) for p in predicates]
+
+    def compile(self):
+        strings = []
+        params = []
+        for predicate in self.predicates:
+            string, predicate_params = predicate.compile()
+            strings.append("(%s)" % string)
+            params += predicate_params
+        if not strings:
+            # An empty AND is true, and an empty OR is false
+            return "TRUE" if self.operator == "AND" else "FALSE", []
+        return (" %s " % self.operator).join(strings), params
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__,
+                           ", ".join(repr(p) for p in self.predicates))
+
+
+class And(_Combination):
+    """All of the given predicates"""
+    operator = "AND"
+
+
+class Or(_Combination):
+    """Any of the given predicates"""
+    operator = "OR"
+
+
+class Not(Predicate):
+    """The negation of a predicate"""
+
+    def __init__(self, predicate):
+        self.predicate = as_predicate(predicate)
+
+    def compile(self):
+        string, params = self.predicate.compile()
+        return "NOT (%s)" % string, params
+
+    def __repr__(self):
+        return "Not(%r)" % (self.predicate, )
+
+
+def as_predicate(condition):
+    """
+    Convert an extract condition to a Predicate.
+
+    Parameters
+    ----------
+    condition:
+        A Predicate (returned as is), a (column, value) tuple (an equality),
+        or a list of conditions (all of which must hold).
+
+    Returns
+    -------
+    predicate:
+        The equivalent Predicate.
+    """
+    if isinstance(condition, Predicate):
+        return condition
+    if isinstance(condition, list):
+        return And(*condition)
+    if isinstance(condition, tuple) and len(condition) == 2:
+        return Eq(*condition)
+    raise ValueError("Cannot interpret %r as a condition" % (condition, ))
+
+
+def compile_conditions(conditions):
+    """
+    Compile extract conditions to a WHERE clause.
+
+    Parameters
+    ----------
+    conditions:
+        None, a Predicate, or a list of Predicates and/or (column, value)
+        equality tuples, all of which must hold.
+
+    Returns
+    -------
+    string, params:
+        The WHERE clause (including the leading ' WHERE ', or an empty string
+        if there are no conditions), and the list of values to bind to its
+        placeholders.
+    """
+    if not conditions:
+        return "", []
+    string, params = as_predicate(conditions).compile()
+    return " WHERE " + string, params
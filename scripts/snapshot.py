@@ -0,0 +1,402 @@
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from extract import _description_structure, psql_to_numpy_dtype, \
+    _cursor_counter
+from predicates import as_predicate, Eq, Range, In, IsNull, And, Or, Not
+
+
+MANIFEST_FILE = "manifest.json"
+NULL_SUFFIX = ".null"
+
+# Value written in place of NULL, by numpy dtype kind; the NULL positions are
+# recorded in a separate <column>.null.npy mask
+_NULL_FILL = {"b": False, "i": 0, "u": 0, "f": np.nan, "S": b"", "U": "",
+              "M": "NaT"}
+
+
+def _column_dtype(psql_dtype, width):
+    """
+    Get the numpy dtype of a snapshot column. Text columns are stored as
+    fixed-width unicode, width characters wide (at least one).
+    """
+    dtype = psql_to_numpy_dtype(psql_dtype)
+    if dtype == "str":
+        dtype = "U%d" % max(width or 0, 1)
+    return np.dtype(dtype)
+
+
+def _column_array(values, dtype):
+    """
+    Convert a list of column values (which may include None) to a numpy
+    array of the given dtype, and a NULL mask.
+    """
+    null = np.fromiter((v is None for v in values), dtype=bool,
+                       count=len(values))
+    if null.any():
+        values = [_NULL_FILL[dtype.kind] if v is None else v for v in values]
+    if dtype.kind == "S":
+        values = [v.encode("utf-8") if not isinstance(v, bytes) else v
+                  for v in values]
+    return np.array(values, dtype=dtype), null
+
+
+def _as_column_value(values, value):
+    """
+    Convert a predicate value to compare against a column array: char and
+    varchar columns are stored as bytes, which never compare equal to str.
+    """
+    if values.dtype.kind == "S" and not isinstance(value, bytes) and \
+            isinstance(value, type(u"")):
+        return value.encode("utf-8")
+    return value
+
+
+def _table_stats(cursor, table, columns, dtypes):
+    """
+    Count the rows of a table, and for each column the non-NULL values and
+    (for text columns) the length of the longest value, in a single scan.
+    """
+    aggregates = ["count(*)"]
+    for column, psql_dtype in zip(columns, dtypes):
+        aggregates.append("count(%s)" % column)
+        aggregates.append("max(char_length(%s))" % column
+                          if psql_to_numpy_dtype(psql_dtype) == "str"
+                          else "NULL")
+    cursor.execute("SELECT %s FROM %s" % (", ".join(aggregates), table))
+    row = cursor.fetchone()
+    return row[0], row[1::2], row[2::2]
+
+
+def _snapshot_tables(cursor):
+    """
+    List the tables and materialized views of the current schema (but not
+    the individual partitions of partitioned tables).
+    """
+    cursor.execute("SELECT c.relname FROM pg_class c "
+                   "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE n.nspname = current_schema() "
+                   "AND c.relkind IN ('r', 'p', 'm') "
+                   "AND NOT c.relispartition ORDER BY c.relname")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def export_snapshot(cursor, out_dir, tables=None, chunk_size=100000):
+    """
+    Export database tables to an offline, columnar snapshot.
+
+    Each column is written to its own .npy file (so that it can be
+    memory-mapped), in <out_dir>/<database version>/<table>/<column>.npy,
+    along with a manifest.json describing the tables. Columns containing
+    NULLs also get a <column>.null.npy boolean mask. The manifest is written
+    last, so a snapshot without one is incomplete.
+
+    Rows are fetched chunk_size at a time and written straight into the
+    memory-mapped column files (sized from a count of the table rows), so
+    tables larger than memory can be exported. The cursor's transaction
+    should be REPEATABLE READ, so that the counts match the rows fetched.
+
+    Parameters
+    ----------
+    cursor:
+        The psycopg2 cursor for interacting with the database.
+    out_dir:
+        The directory to write the snapshot to.
+    tables:
+        List of the names of the tables to export. Defaults to None, which
+        exports all tables and materialized views in the current schema.
+    chunk_size:
+        Integer, denoting the number of rows to fetch at a time. Defaults to
+        100000.
+
+    Returns
+    -------
+    snapshot_dir:
+        The directory holding the snapshot.
+    """
+    cursor.execute("SELECT version FROM version v "
+                   "ORDER BY v.version_date DESC LIMIT 1")
+    version = cursor.fetchall()[0][0]
+    if tables is None:
+        tables = _snapshot_tables(cursor)
+
+    snapshot_dir = os.path.join(out_dir, version)
+    manifest = {"version": version, "created": time.time(), "tables": {}}
+    start = time.time()
+    for table in tables:
+        cursor.execute("SELECT * FROM %s LIMIT 0" % table)
+        columns, dtypes = _description_structure(cursor.description)
+        n_rows, counts, widths = _table_stats(cursor, table, columns, dtypes)
+
+        # Each column (and NULL mask) is written through a memory-mapped
+        # .npy file, sized from the row count, as its chunks arrive
+        table_dir = os.path.join(snapshot_dir, table)
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+        arrays = []
+        nulls = []
+        column_entries = []
+        for column, psql_dtype, count, width in zip(columns, dtypes, counts,
+                                                    widths):
+            dtype = _column_dtype(psql_dtype, width)
+            arrays.append(np.lib.format.open_memmap(
+                os.path.join(table_dir, column + ".npy"), mode="w+",
+                dtype=dtype, shape=(n_rows, )))
+            nullable = count < n_rows
+            nulls.append(np.lib.format.open_memmap(
+                os.path.join(table_dir, column + NULL_SUFFIX + ".npy"),
+                mode="w+", dtype=bool, shape=(n_rows, ))
+                if nullable else None)
+            column_entries.append({"name": column, "psql_type": psql_dtype,
+                                   "dtype": dtype.str,
+                                   "nullable": nullable})
+
+        stream = cursor.connection.cursor(
+            name="snapshot_%d" % (next(_cursor_counter), ))
+        try:
+            stream.execute("SELECT * FROM %s" % table)
+            offset = 0
+            while True:
+                chunk = stream.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                if offset + len(chunk) > n_rows:
+                    raise ValueError("Table %s changed during the export; "
+                                     "export in a REPEATABLE READ "
+                                     "transaction" % table)
+                for i, (array, null) in enumerate(zip(arrays, nulls)):
+                    values, null_values = _column_array(
+                        [row[i] for row in chunk], array.dtype)
+                    array[offset:offset + len(chunk)] = values
+                    if null is not None:
+                        null[offset:offset + len(chunk)] = null_values
+                offset += len(chunk)
+        finally:
+            stream.close()
+        if offset != n_rows:
+            raise ValueError("Table %s changed during the export; export in "
+                             "a REPEATABLE READ transaction" % table)
+        for array in arrays + [null for null in nulls if null is not None]:
+            array.flush()
+        del arrays, nulls
+
+        manifest["tables"][table] = {"rows": n_rows,
+                                     "columns": column_entries}
+        logging.info("Exported %d rows of %s" % (n_rows, table))
+
+    with open(os.path.join(snapshot_dir, MANIFEST_FILE), "w") as fileobj:
+        json.dump(manifest, fileobj, indent=2, sort_keys=True)
+    logging.info("Exported %d tables to %s in %.2f s" % (
+        len(tables), snapshot_dir, time.time() - start))
+    return snapshot_dir
+
+
+class Snapshot(object):
+    """
+    A read-only, database-free backend for the extract functions.
+
+    A Snapshot may be passed in place of the cursor to extract_from,
+    extract_from_joined, iter_extract_from, extract_from_binary and the
+    readout modules. Columns are memory-mapped from the snapshot files, and
+    only the rows and columns selected are copied into the result.
+
+    Conditions may use the Eq, Range, In, IsNull, And, Or and Not predicates
+    (or (column, value) equality tuples); Sql predicates cannot be evaluated
+    without a database.
+
+    Parameters
+    ----------
+    path:
+        The snapshot directory (containing manifest.json), as returned by
+        export_snapshot.
+    """
+
+    # Checked by the extract functions, which dispatch to extract below
+    is_snapshot = True
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as fileobj:
+            self.manifest = json.load(fileobj)
+        self.version = self.manifest["version"]
+        self._columns = {}
+
+    def __repr__(self):
+        return "Snapshot(%r, version %s)" % (self.path, self.version)
+
+    def table_columns(self, table):
+        """The column names of table, in order"""
+        try:
+            entries = self.manifest["tables"][table]["columns"]
+        except KeyError:
+            raise ValueError("Table %s is not in snapshot %s" % (
+                table, self.path))
+        return [entry["name"] for entry in entries]
+
+    def column(self, table, column, null=False):
+        """
+        Get a column (or, if null is True, its NULL mask, or None if it has
+        no NULLs) as a read-only memory-mapped array.
+        """
+        column = column.lower()
+        if column not in self.table_columns(table):
+            raise ValueError("Column %s not found in %s" % (column, table))
+        key = (table, column, null)
+        if key not in self._columns:
+            filename = os.path.join(self.path, table, column + (
+                NULL_SUFFIX if null else "") + ".npy")
+            if null and not os.path.exists(filename):
+                self._columns[key] = None
+            else:
+                self._columns[key] = np.load(filename, mmap_mode="r")
+        return self._columns[key]
+
+    def _relation(self, tables):
+        """
+        NATURAL JOIN tables, returning the (table, row index) of each, where
+        a row index of None means all rows in order.
+        """
+        sources = [(tables[0], None)]
+        length = self.manifest["tables"][tables[0]]["rows"]
+        for table in tables[1:]:
+            known = set(sum([self.table_columns(t) for t, _ in sources], []))
+            common = [c for c in self.table_columns(table) if c in known]
+            if not common:
+                raise ValueError("No common column to join %s on" % table)
+            left = self._get(sources, common[0])
+            right = self.column(table, common[0])
+            order = np.argsort(right, kind="mergesort")
+            ordered = right[order]
+            lo = np.searchsorted(ordered, left, side="left")
+            counts = np.searchsorted(ordered, left, side="right") - lo
+            left_index = np.repeat(np.arange(len(left)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts)
+            right_index = order[np.repeat(lo, counts) + offsets]
+            sources = [(t, left_index if index is None else index[left_index])
+                       for t, index in sources] + [(table, right_index)]
+            length = len(left_index)
+            for column in common[1:]:
+                # Any further common columns must match too
+                keep = np.asarray(self._get(sources[:-1], column) ==
+                                  self.column(table, column)[right_index])
+                sources = [(t, (np.arange(length) if index is None
+                                else index)[keep])
+                           for t, index in sources]
+                length = int(keep.sum())
+        return sources, length
+
+    def _get(self, sources, column, null=False):
+        column = column.lower()
+        for table, index in sources:
+            if column in self.table_columns(table):
+                array = self.column(table, column, null=null)
+                if array is None or index is None:
+                    return array
+                return array[index]
+        raise ValueError("Column %s not found in %s" % (
+            column, ", ".join(t for t, _ in sources)))
+
+    def _mask(self, predicate, sources, length):
+        """Evaluate a predicate to a boolean mask over the relation rows"""
+        if isinstance(predicate, (And, Or)):
+            masks = [self._mask(p, sources, length)
+                     for p in predicate.predicates]
+            if not masks:
+                return np.full(length, isinstance(predicate, And))
+            combine = np.logical_and if isinstance(predicate, And) \
+                else np.logical_or
+            return combine.reduce(masks)
+        if isinstance(predicate, Not):
+            return ~self._mask(predicate.predicate, sources, length)
+
+        null = self._get(sources, predicate.column, null=True)
+        if isinstance(predicate, IsNull):
+            if null is None:
+                null = np.zeros(length, dtype=bool)
+            return ~null if not predicate.null else np.array(null)
+
+        values = self._get(sources, predicate.column)
+        if isinstance(predicate, Eq):
+            mask = values == _as_column_value(values, predicate.value)
+        elif isinstance(predicate, Range):
+            mask = np.ones(length, dtype=bool)
+            if predicate.low is not None:
+                mask &= values >= _as_column_value(values, predicate.low)
+            if predicate.high is not None:
+                mask &= values <= _as_column_value(values, predicate.high)
+        elif isinstance(predicate, In):
+            mask = np.isin(values, [_as_column_value(values, v)
+                                    for v in predicate.values])
+        else:
+            raise ValueError("Condition %r cannot be evaluated against a "
+                             "snapshot" % (predicate, ))
+        mask = np.asarray(mask, dtype=bool)
+        if null is not None:
+            # As in SQL, comparisons with NULL are never true
+            mask &= ~null
+        return mask
+
+    def extract(self, table, conditions=None, columns=None):
+        """
+        Extract rows from a snapshot table, or a NATURAL JOIN of tables.
+
+        Parameters
+        ----------
+        table:
+            The name of the table to be read, or a list of table names to be
+            NATURAL JOINed.
+        conditions:
+            The conditions rows must satisfy, as for extract.extract_from.
+            Defaults to None.
+        columns:
+            List of column names to retrieve. Defaults to None, which returns
+            all available columns.
+
+        Returns
+        -------
+        result:
+            A numpy structured array of all rows which satisfy conditions (if
+            given), as for extract.extract_from.
+        """
+        tables = [table] if isinstance(table, str) else list(table)
+        sources, length = self._relation(tables)
+        if columns is None:
+            columns = []
+            for t in tables:
+                columns += [c for c in self.table_columns(t)
+                            if c not in columns]
+
+        selection = None
+        if conditions:
+            selection = np.flatnonzero(
+                self._mask(as_predicate(conditions), sources, length))
+
+        arrays = []
+        for column in columns:
+            array = self._get(sources, column)
+            arrays.append(array if selection is None else array[selection])
+        result = np.empty(length if selection is None else len(selection),
+                          dtype=[(c, a.dtype) for c, a in
+                                 zip(columns, arrays)])
+        for column, array in zip(columns, arrays):
+            result[column] = array
+        return result
+
+
+if __name__ == "__main__":
+    from connection import get_connection
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python scripts/snapshot.py <output directory>")
+    connection = get_connection()
+    # The row counts must match the rows streamed
+    connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    export_snapshot(connection.cursor(), sys.argv[1])
+    connection.rollback()
+    connection.close()
@@ -1,5 +1,8 @@
 from connection import get_connection
-from create import create_tables, insert_row
+from create import create_tables, build_deferred, drop_tables, insert_row, \
+    existing_tables, create_views, refresh_views, prune_table_changes
+from ingest import clear_checkpoints
+from parallel import run_parallel_ingest, merge_staging, drop_staging
 import os
 import logging
 import imp
@@ -7,7 +10,7 @@ import psycopg2
 import sys
 
 
-def update_database(connection):
+def update_database(connection, parallel=False, defer=False, resume=False):
     dirname = os.path.dirname(__file__)
     if not dirname:
         dirname = "."
@@ -29,7 +32,26 @@ def update_database(connection):
         return
     logging.info("Updating from version %s through versions %s" % (current_version, versions_needed_to_update))
     for v in versions_needed_to_update:
-        update_to_version(connection, version_dir + os.sep + v)
+        try:
+            update_to_version(connection, version_dir + os.sep + v,
+                              parallel=parallel, defer=defer, resume=resume)
+        finally:
+            # The schema has (potentially) changed, so cached table
+            # structures are no longer valid for the next version's loaders
+            invalidate_schema_caches()
+
+
+def invalidate_schema_caches():
+    """
+    Discard the table structures cached by the extract module, for all
+    connections. The module is imported both as extract (by these scripts)
+    and as scripts.extract (by the loaders, readouts and benchmarks), and
+    each import has its own caches, so all of them are cleared.
+    """
+    for name in ("extract", "scripts.extract"):
+        module = sys.modules.get(name)
+        if module is not None:
+            module.invalidate_schema_cache()
 
 
 def get_current_version(connection):
@@ -48,34 +70,99 @@ def get_current_version(connection):
     return result[0]
 
 
-def update_to_version(connection, version_dir):
+def update_to_version(connection, version_dir, parallel=False, defer=False,
+                      resume=False):
     logging.info("Updating to version %s" % os.path.basename(version_dir))
 
     table_dir = version_dir + os.sep + "tables"
 
     if connection is None:
         cursor = None
+        parallel = False
+        resume = False
     else:
         cursor = connection.cursor()
+    tables = []
+    staging = []
+    # In defer mode, constraints and secondary indexes are only built once
+    # the data have been loaded
+    deferred = [] if defer else None
+    if resume and parallel:
+        logging.warning("Resumable loads commit as they go, and so cannot be "
+                        "run in parallel; loading serially")
+        parallel = False
     try:
-        if os.path.exists(table_dir):
-            create_tables(cursor, table_dir)
+        if os.path.exists(table_dir) and resume:
+            # The tables are committed up front, and kept if the upgrade
+            # fails, so that a re-run can resume loading into them
+            tables = create_tables(None, table_dir, deferred=deferred)
+            existing = existing_tables(cursor, tables)
+            if existing == tables:
+                logging.info("Resuming upgrade into existing tables")
+            elif existing:
+                raise ValueError("Cannot resume: only tables %s of %s exist" %
+                                 (existing, tables))
+            else:
+                create_tables(cursor, table_dir,
+                              deferred=None if deferred is None else [])
+                connection.commit()
+        elif os.path.exists(table_dir):
+            tables = create_tables(cursor, table_dir, deferred=deferred)
 
         ingest_file = version_dir + os.sep + "ingest" + os.sep + "execute.py"
         if os.path.exists(ingest_file):
             execute = imp.load_source('execute', ingest_file)
-            execute.update(cursor, os.path.dirname(ingest_file))
+            if parallel and hasattr(execute, 'catalog_jobs'):
+                # The loaders write into staging copies of the tables over
+                # their own connections, so the new (empty) tables must be
+                # committed first. The staged rows are then moved into the
+                # tables in this transaction, and so are only committed
+                # along with the rest of the upgrade; if anything fails,
+                # the upgrade is undone by dropping the new tables again.
+                connection.commit()
+                staging = run_parallel_ingest(
+                    connection,
+                    execute.catalog_jobs(os.path.dirname(ingest_file)))
+                merge_staging(cursor, staging)
+                if hasattr(execute, 'finalize'):
+                    execute.finalize(cursor, os.path.dirname(ingest_file))
+            elif resume:
+                execute.update(cursor, os.path.dirname(ingest_file),
+                               resume=True)
+            else:
+                execute.update(cursor, os.path.dirname(ingest_file))
 
         scripts_file = version_dir + os.sep + "scripts" + os.sep + "execute.py"
         if os.path.exists(scripts_file):
             execute = imp.load_source('execute', scripts_file)
             execute.update(cursor, os.path.diranem(scripts_file))
 
+        build_deferred(cursor, deferred or [], tables)
+
+        # Bring the views of earlier versions up to date with the data loaded
+        # by this one, then create (and populate) this version's views
+        refresh_views(cursor)
+        views_dir = version_dir + os.sep + "views"
+        if os.path.exists(views_dir):
+            create_views(cursor, views_dir)
+
+        if resume:
+            clear_checkpoints(cursor)
+        prune_table_changes(cursor)
+
         insert_row(cursor, "version", os.path.basename(version_dir), columns=["version"])
+        drop_staging(cursor, staging)
     except Exception as e:
         logging.critical(e)
         logging.warn("Rolling back")
         connection.rollback()
+        if parallel:
+            drop_staging(cursor, staging)
+            drop_tables(cursor, tables)
+            connection.commit()
+        elif resume:
+            logging.warn("Loaded catalogue chunks have been kept; re-run "
+                         "with resume to continue the upgrade")
         raise
     else:
         if cursor is not None:
@@ -88,4 +175,6 @@ if __name__ == "__main__":
         connection = None
     else:
         connection = get_connection()
-    update_database(connection)
+    update_database(connection, parallel="parallel" in sys.argv[1:],
+                    defer="defer" in sys.argv[1:],
+                    resume="resume" in sys.argv[1:])